@@ -7,10 +7,23 @@ import subprocess
 import usb.core, usb.util  # pyusb
 import zlib
 import array
+import mmap
+import json
+import argparse
+import multiprocessing
 import struct
 import sys
 import socket
-import ctypes as ct
+import threading
+import collections
+import contextlib
+import difflib
+import base64
+import bisect
+import tempfile
+import asyncio
+import functools
+import concurrent.futures
 rx_cnt = 18
 tx_cnt =  36
 lst_file_path = None
@@ -25,6 +38,29 @@ class ImageFileReadError(ImageFileError):
 class ImageFileWriteError(ImageFileError):
     pass
 
+SAVE_CHUNK_SIZE = 64 * 1024
+
+class FlashArea(object):
+    """One flash area of a TouchBootImageFile.
+
+       The fields have the same meaning as the addFlashArea arguments
+       of the same names. Subscripting by field name (area['data'])
+       is kept for code written against the old dict records.
+    """
+
+    __slots__ = ('name', 'address', 'data', 'flags', 'length', 'crc')
+
+    def __init__(self, name, address, data, flags, length, crc):
+        self.name = name
+        self.address = address
+        self.data = data
+        self.flags = flags
+        self.length = length
+        self.crc = crc
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
 class TouchBootImageFile(object):
     """Representation of a TouchBoot image file.
 
@@ -36,7 +72,11 @@ class TouchBootImageFile(object):
     def __init__(self):
         """Create a new empty TouchBootImageFile object."""
         self.flashAreas = []
+        self.flashAreaIndex = {}
         self.jsonSection = None
+        self.compressedJSONSection = None
+        self.uncheckedAreas = set()
+        self.mapping = None
 
     def addFlashArea(self, name, address, data, flags, length,crc):
         """Add a flash area.
@@ -49,14 +89,9 @@ class TouchBootImageFile(object):
                        flag supported is "always overwrite".
         """
 
-        area = {'name' : name,
-                'address' : address,
-                'data' : data,
-                'flags' : flags,
-                'length' : length,
-                'crc' : crc,
-               }
+        area = FlashArea(name, address, data, flags, length, crc)
         self.flashAreas.append(area)
+        self.flashAreaIndex[name] = area
 
     def getFlashArea(self, name):
         """Returns specified flash area contents.
@@ -67,15 +102,31 @@ class TouchBootImageFile(object):
            Return value
 
              If the area does not exist, return None. If the area does
-             exist, return a dict with the fields 'name', 'address',
-             'data', and 'flags' which have the same format as the
-             addFlashArea arguments of the same names.
+             exist, return its FlashArea record.
+        """
+
+        area = self.flashAreaIndex.get(name)
+        if area is not None and name in self.uncheckedAreas:
+            self.checkFlashArea(area)
+        return area
+
+    def checkFlashArea(self, area):
+        """Checks the CRC of a flash area loaded lazily.
+
+           Raises ImageFileReadError if the area contents do not match
+           the CRC stored in the image file.
         """
 
+        if area.crc != zlib.crc32(area.data) & 0xFFFFFFFF:
+            raise ImageFileReadError("CRC mismatch in flash area %s" % area.name)
+        self.uncheckedAreas.discard(area.name)
+
+    def verifyCRC(self):
+        """Checks the CRC of every flash area not checked yet."""
+
         for area in self.flashAreas:
-            if name == area['name']:
-                return area
-        return None
+            if area.name in self.uncheckedAreas:
+                self.checkFlashArea(area)
 
     def setJSONSection(self, jsonData):
         """Puts the specified data in the JSON section.
@@ -89,114 +140,309 @@ class TouchBootImageFile(object):
     def getJSONSection(self):
         """Returns the contents of the JSON section (or None if empty)."""
 
+        if self.compressedJSONSection is not None:
+            self.jsonSection = zlib.decompress(self.compressedJSONSection)
+            self.compressedJSONSection = None
         return self.jsonSection
 
-    def save(self, filename):
+    def close(self):
+        """Releases the file mapping of an object loaded with lazy=True.
+
+           Area data of such an object must not be used afterwards.
+        """
+
+        if self.mapping is None:
+            return
+        for area in self.flashAreas:
+            if isinstance(area.data, memoryview):
+                area.data.release()
+        if self.compressedJSONSection is not None:
+            self.compressedJSONSection.release()
+            self.compressedJSONSection = None
+        try:
+            self.mapping.close()
+        except BufferError:
+            # views derived from the area data are still alive, the
+            # mapping is closed when the last of them is collected
+            pass
+        self.mapping = None
+
+    @staticmethod
+    def areaBytes(data):
+        """Returns area data as a byte memoryview.
+
+           Lists of 16-bit words are packed into an array first; any
+           other buffer (bytearray, array, memoryview of a mapped
+           image) is viewed in place without copying.
+        """
+
+        if isinstance(data, list):
+            data = array.array('H', data)
+        return memoryview(data).cast('B')
+
+    def save(self, filename, compressLevel=9):
         """Writes a TouchBoot image file with the object's contents.
 
+           Area data is written straight from its buffer in chunks
+           while the CRC is computed, and the CRC is patched into the
+           area header afterwards, so each area is read only once.
+
+           The file is written under a temporary name in the same
+           directory and then renamed over filename, so an image
+           loaded lazily from filename can be saved back to it.
+
            Arguments
              - filename : the file name to use for the output file.
+             - compressLevel : zlib compression level (0-9) of the
+                               JSON section.
         """
 
-        f = open(filename, 'wb')
-        f.write(struct.pack('<L', 0x4818472B))
-        sections = len(self.flashAreas) + (0 if self.jsonSection is None else 1)
-        f.write(struct.pack('<L', sections))
+        directory = os.path.dirname(os.path.abspath(filename))
+        fd, tmpName = tempfile.mkstemp(prefix='.' + os.path.basename(filename), dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                self.writeTo(f, compressLevel)
+            if os.path.exists(filename):
+                mode = os.stat(filename).st_mode
+            else:
+                umask = os.umask(0)
+                os.umask(umask)
+                mode = 0o666 & ~umask
+            os.chmod(tmpName, mode & 0o7777)
+            os.replace(tmpName, filename)
+        except BaseException:
+            os.remove(tmpName)
+            raise
+
+    def writeTo(self, f, compressLevel=9):
+        """Writes the image to an open binary file, see save."""
+
+        areaData = [self.areaBytes(area.data) for area in self.flashAreas]
+        jsonData = self.getJSONSection()
+        sections = len(self.flashAreas) + (0 if jsonData is None else 1)
+
+        f.write(struct.pack('<LL', 0x4818472B, sections))
 
         offset = 8 + 4 * sections
-        for area in self.flashAreas:
+        for data in areaData:
             f.write(struct.pack('<L', offset))
-            offset += 36 + len(area['data'])*2
+            offset += 36 + data.nbytes
 
-        if self.jsonSection is not None:
+        if jsonData is not None:
             f.write(struct.pack('<L', offset))
 
-        for area in self.flashAreas:
+        for area, data in zip(self.flashAreas, areaData):
             f.write(struct.pack('<L', 0x7C05E516))
-            idString = ("%-16s" % area['name'])[0:16]
+            idString = ("%-16s" % area.name)[0:16]
             f.write(idString.encode('ascii', 'ignore'))
             flags = 0
-            if area['flags'].get('alwaysOverwrite', False):
+            if area.flags.get('alwaysOverwrite', False):
                 flags |= 1
 
-            f.write(struct.pack('<L', flags))
-            f.write(struct.pack('<L', area['address']))
-            f.write(struct.pack('<L', len(area['data'])*2))
-
-            data = array.array('H', area['data'])
-            if sys.version_info[0] == 3:
-                data = data.tobytes()
-            else:
-                data = data.tostring()
-            crc = zlib.crc32(data) & 0xFFFFFFFF
-            f.write(struct.pack('<L', crc))
-            f.write(data)
-
-        if self.jsonSection is not None:
-            compressedJsonData = zlib.compress(self.jsonSection, 9)
+            f.write(struct.pack('<LLL', flags, area.address, data.nbytes))
+            crcOffset = f.tell()
+            f.write(struct.pack('<L', 0))
+            crc = 0
+            for start in range(0, data.nbytes, SAVE_CHUNK_SIZE):
+                chunk = data[start:start + SAVE_CHUNK_SIZE]
+                crc = zlib.crc32(chunk, crc)
+                f.write(chunk)
+            endOffset = f.tell()
+            f.seek(crcOffset)
+            f.write(struct.pack('<L', crc & 0xFFFFFFFF))
+            f.seek(endOffset)
+
+        if jsonData is not None:
+            if isinstance(jsonData, str):
+                jsonData = jsonData.encode('utf-8')
+            jsonData = memoryview(jsonData)
             f.write(struct.pack('<L', 0xC1FB41D8))
-            f.write(struct.pack('<L', len(compressedJsonData)))
-            f.write(compressedJsonData)
+            lengthOffset = f.tell()
+            f.write(struct.pack('<L', 0))
+            compressor = zlib.compressobj(compressLevel)
+            length = 0
+            for start in range(0, jsonData.nbytes, SAVE_CHUNK_SIZE):
+                compressed = compressor.compress(jsonData[start:start + SAVE_CHUNK_SIZE])
+                f.write(compressed)
+                length += len(compressed)
+            compressed = compressor.flush()
+            f.write(compressed)
+            length += len(compressed)
+            f.seek(lengthOffset)
+            f.write(struct.pack('<L', length))
 
     @staticmethod
-    def load(filename):
+    def load(filename, lazy=False):
         """Create a TouchBootImageFile object from a file.
 
            Arguments
              - filename : the file to load.
+             - lazy : map the file instead of reading it. Only the
+                      header and section table are parsed, area data
+                      is a read-only memoryview into the mapping, and
+                      the CRC of an area is checked the first time
+                      getFlashArea returns it (or for all areas by
+                      verifyCRC). Call close() when done.
 
            Return value
              A new TouchBootImageFile object.
         """
 
-        f = open(filename, 'rb')
+        with open(filename, 'rb') as f:
+            if lazy:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                buf = f.read()
         obj = TouchBootImageFile()
+        view = memoryview(buf)
 
         # check header
 
-        magic = struct.unpack('<L', f.read(4))[0]
+        magic, sections = struct.unpack_from('<LL', buf, 0)
         if magic != 0x4818472B:
             raise ImageFileReadError('Bad magic value 0x%08X != 0x4818472B\n', magic)
 
-        sections = struct.unpack('<L', f.read(4))[0]
-        offsets = []
-        for s in range(sections):
-            offsets.append(struct.unpack('<L', f.read(4))[0])
+        offsets = struct.unpack_from('<%dL' % sections, buf, 8)
 
         for addr in offsets:
-            f.seek(addr)
-
-            magic = struct.unpack('<L', f.read(4))[0]
+            magic = struct.unpack_from('<L', buf, addr)[0]
             if magic == 0x7C05E516: # Flash area
-                name = f.read(16).decode('ascii').rstrip()
-                rawFlags = struct.unpack('<L', f.read(4))[0]
+                name = bytes(view[addr + 4:addr + 20]).decode('ascii').rstrip()
+                rawFlags, destAddr, length, crc = struct.unpack_from('<LLLL', buf, addr + 20)
                 flags = {
                     'alwaysOverwrite' : (rawFlags & 1) == 1
                     }
-                destAddr = struct.unpack('<L', f.read(4))[0]
-                length = struct.unpack('<L', f.read(4))[0]
-                crc = struct.unpack('<L', f.read(4))[0]
                 #print(name, str(hex(crc)))
-                data = f.read(length)
-                #print(type(data))
-                if crc != zlib.crc32(data) & 0xFFFFFFFF:
-                    raise ImageFileReadError("CRC mismatch in flash area %s" % name)
-
-                #data = array.array('H', data).tolist()
-                data = bytearray(data)
+                data = view[addr + 36:addr + 36 + length]
+                if len(data) != length:
+                    raise ImageFileReadError("Flash area %s truncated" % name)
+                if lazy:
+                    obj.uncheckedAreas.add(name)
+                else:
+                    if crc != zlib.crc32(data) & 0xFFFFFFFF:
+                        raise ImageFileReadError("CRC mismatch in flash area %s" % name)
+                    data = bytearray(data)
                 obj.addFlashArea(name, destAddr, data, flags, length,crc)
 
             elif magic == 0xC1FB41D8: # JSON area
-                length = struct.unpack('<L', f.read(4))[0]
-                jsonData = zlib.decompress(f.read(length))
-
-                obj.setJSONSection(jsonData)
+                length = struct.unpack_from('<L', buf, addr + 4)[0]
+                if lazy:
+                    obj.compressedJSONSection = view[addr + 8:addr + 8 + length]
+                else:
+                    obj.setJSONSection(zlib.decompress(view[addr + 8:addr + 8 + length]))
 
             else:
                 raise ImageFileReadError("Unknown section type: %08X" % magic)
 
+        if lazy:
+            obj.mapping = buf
+        else:
+            view.release()
         return obj
 
+def verify_image(path):
+    # check one image file, result is a json-friendly dict
+    start = time.time()
+    report = {'file': path, 'ok': False, 'error': None, 'size': None, 'areas': [], 'json_size': None}
+    try:
+        report['size'] = os.path.getsize(path)
+        img = TouchBootImageFile.load(path, lazy=True)
+        try:
+            img.verifyCRC()
+            for area in img.flashAreas:
+                report['areas'].append({'name': area.name,
+                                        'address': area.address,
+                                        'length': area.length,
+                                        'crc': '%08X' % area.crc})
+            jsonData = img.getJSONSection()
+            if jsonData is not None:
+                report['json_size'] = len(jsonData)
+        finally:
+            img.close()
+        report['ok'] = True
+    except (ImageFileError, zlib.error, struct.error, ValueError, OSError) as e:
+        report['error'] = '%s: %s' % (type(e).__name__, e)
+    report['seconds'] = time.time() - start
+    return report
+
+def find_images(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in names if name.lower().endswith('.img'))
+        else:
+            files.append(path)
+    return sorted(files)
+
+def verify_images(paths, jobs=None):
+    files = find_images(paths)
+    if jobs == 1 or len(files) <= 1:
+        return [verify_image(f) for f in files]
+    with multiprocessing.Pool(jobs) as pool:
+        return pool.map(verify_image, files, chunksize=1)
+
+def verify_main(argv):
+    parser = argparse.ArgumentParser(prog='cdci.py verify',
+                                     description='Check magic, section table, area CRC32 and JSON section of TouchBoot images.')
+    parser.add_argument('paths', nargs='+', help='image files or directories to search for *.img')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='worker processes (default: all cores)')
+    parser.add_argument('-o', '--output', default=None, help='write the JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+
+    start = time.time()
+    reports = verify_images(args.paths, args.jobs)
+    failed = [r for r in reports if not r['ok']]
+    result = {'files': reports,
+              'total': len(reports),
+              'failed': len(failed),
+              'seconds': time.time() - start}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print('')
+    for r in failed:
+        print('FAIL %s: %s' % (r['file'], r['error']), file=sys.stderr)
+    print('%d images, %d failed, %.2fs' % (len(reports), len(failed), result['seconds']), file=sys.stderr)
+    return 1 if failed else 0
+
+# report payload length in bytes -> (rows, cols) of 16-bit cells
+FRAME_SHAPES = {
+    36 * 16 * 2: (36, 16),
+    36 * 18 * 2: (36, 18),
+    34 * 15 * 2: (34, 15),
+}
+
+def frame_shape(data_len):
+    if data_len in FRAME_SHAPES:
+        return FRAME_SHAPES[data_len]
+    if data_len == tx_cnt * rx_cnt * 2:
+        return (tx_cnt, rx_cnt)
+    return None
+
+def decode_frame(payload):
+    # whole payload to signed little-endian 16-bit cells in one step
+    frame = array.array('h')
+    frame.frombytes(payload[:len(payload) & ~1])
+    if sys.byteorder == 'big':
+        frame.byteswap()
+    return frame
+
+def format_frame(frame, rows, cols):
+    cell = '{:4d} ' * cols
+    lines = ['r\\c:' + cell.format(*range(cols)), '']
+    for row in range(rows):
+        lines.append('%2d: ' % row + cell.format(*frame[row * cols:(row + 1) * cols]))
+    return '\n'.join(lines) + '\n'
+
+def format_hex_dump(data, line_len=32):
+    lines = ['     ' + ''.join('{:02d} '.format(i) for i in range(line_len))]
+    for address in range(0, len(data), line_len):
+        lines.append('{:04d}:'.format(address) + bytes(data[address:address + line_len]).hex(' ').upper() + ' ')
+    return '\n'.join(lines)
+
 STD_INPUT_HANDLE = -10
 STD_OUTPUT_HANDLE = -11
 STD_ERROR_HANDLE = -12
@@ -207,7 +453,629 @@ VDDIO_VOLTAGE = 1800
 SPI_MODE = 3
 SPI_SPEED = 1000
 
-NORMAL_SLEEP_TIME=0.1
+# longest time (seconds) a command may take to post its response,
+# keyed by command code
+COMMAND_TIMEOUTS = {
+    '02': 1,    # identify
+    '04': 2,    # reset
+    '11': 10,   # erase flash
+    '12': 1,    # write flash
+    '13': 1,    # read flash
+    '14': 2,    # run application firmware
+    '1f': 2,    # enter bootloader
+    '30': 2,    # download config
+    '81': 1,    # read ram
+    'hdl': 2,   # host download, until the firmware reports in
+}
+DEFAULT_COMMAND_TIMEOUT = 1
+POLL_FIRST_INTERVAL = 0.0005
+POLL_MAX_INTERVAL = 0.05
+
+# most 16-bit words one 81 (read ram) command is asked for
+RAM_READ_MAX_WORDS = 1024
+# ranges this many words apart or closer share one 81 read, the
+# words in between are read and thrown away
+RAM_READ_MAX_GAP = 4
+
+# host download goes to the bridge in chunks of this many bytes
+HDL_CHUNK_SIZE = 512
+HDL_SPI_CONFIG = 'target=0 config raw pl=spi pull-ups=yes spiMode=3 byteDelay=10 bitRate=500 attn=none ssActive=low mode=slave'
+
+# ===== MPC04 reply parsing =====
+# the bridge quotes the TouchComm bytes as hex, e.g. ... data="A5010400xxxxxxxx"
+MPC04_PACKET = re.compile(r'"(A5[^"\s]*)"')
+MPC04_DATA = re.compile(r'data="([^"\s]*)"')
+
+# status : TouchComm status code (second byte), None if no packet
+# error : the bridge reported an error
+# hex : the packet as hex text, None if no packet
+# packet : the packet as bytes, None if no packet
+MPC04Reply = collections.namedtuple('MPC04Reply', 'status error hex packet')
+
+NO_REPLY = MPC04Reply(None, False, None, None)
+
+# a TouchComm message, code is the status (or report) code
+TcmMessage = collections.namedtuple('TcmMessage', 'code length payload')
+
+IDLE_MESSAGE = TcmMessage(0, 0, b'')
+
+def message_hex(msg):
+    return (struct.pack('<BBH', 0xA5, msg.code, msg.length) + msg.payload).hex().upper()
+
+def parse_response(text):
+    if text == None:
+        return NO_REPLY
+    error = 'err' in text
+    m = MPC04_PACKET.search(text)
+    if m == None:
+        return MPC04Reply(None, error, None, None)
+    packet_hex = m.group(1)
+    try:
+        packet = bytes.fromhex(packet_hex)
+    except ValueError:
+        return MPC04Reply(None, error, None, None)
+    return MPC04Reply(packet[1] if len(packet) > 1 else None, error, packet_hex, packet)
+
+# ===== transports =====
+# a transport moves one MPC04 command line out and one reply text back.
+# write(line) sends a line (with its '\n'), read() returns the next reply
+# text or None when nothing came back in time.
+
+class UsbTransport:
+    def __init__(self, device=None):
+        self.connected = False
+        # device picks one adapter when several are plugged in
+        if device == None:
+            device = usb.core.find(idVendor=0x06CB, idProduct=0x000F)
+        self.usb = device
+        if self.usb is None:
+            print('Cannot connect to mpc04, make sure it\'s plugged in USB port.')
+            return
+
+        self.out_endpoint_addr = 0x1
+        self.in_endpoint_addr = 0x82
+        self.usb.set_configuration()
+
+        # get an endpoint instance
+        cfg = self.usb.get_active_configuration()
+        intf = cfg[(0, 0)]
+        self.ep_in = usb.util.find_descriptor(
+          intf,
+          # match the first IN endpoint
+          custom_match= \
+            lambda e: \
+              usb.util.endpoint_direction(e.bEndpointAddress) == \
+              usb.util.ENDPOINT_IN)
+
+        if self.ep_in == None:
+            print("Error: USB endpoint_in Error")
+            return
+
+        # reused by every read
+        self.usb_packet = array.array('B', bytes(self.ep_in.wMaxPacketSize))
+        self.usb_read_buf = bytearray()
+
+        self.connected = True
+
+    def write(self, line):
+        self.usb.write(self.out_endpoint_addr, line)
+
+    def _readPacket(self):
+        # read one packet straight into the preallocated packet buffer
+        try:
+            return self.usb.read(self.in_endpoint_addr, self.usb_packet)
+        except:
+            return 0
+
+    def read(self):
+        buf = self.usb_read_buf
+        del buf[:]
+        packet = memoryview(self.usb_packet)
+        data_len = self._readPacket()
+        if data_len == 0:
+            return None
+        buf += packet[:data_len]
+        # 檢查 response是否結束，以避免以下狀況 :
+        # 1_讀取速度太快，其中有幾次讀不到資料造成資料讀取不完整
+        # 2_該command會多次返回，例如 identify
+        # =====================================
+        # 10(0x0a) is end code of usb response,
+        # get 10(0x0a) means the response is complete,
+        # only the newest packet can hold it
+        while packet[data_len - 1] != 10:
+            data_len = self._readPacket()
+            if data_len == 0:
+                break
+            buf += packet[:data_len]
+
+        # 把 hex-string 轉成 ascii
+        return buf.decode('latin-1')
+
+    def close(self):
+        if self.usb is not None:
+            usb.util.dispose_resources(self.usb)
+        self.connected = False
+
+class SocketTransport:
+    def __init__(self, host='127.0.0.1', port=10001):
+        #===== initial socket =====
+        print("connect use red remote")
+        self.connected = False
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # small request/reply lines, don't let nagle hold them back
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            result = self.socket.connect((host, port))
+        except:
+            print(
+                'Cannot connect to redremote server, make sure RedRemote is running.'
+            )
+            return
+        #設定recv的timeout時間
+        print("connect result", result)
+        # upper bound only, reads return as soon as the reply is complete
+        self.socket.settimeout(0.2)
+        self.sock_chunk = bytearray(4096)
+        self.sock_buf = bytearray()
+        self.connected = True
+
+    def write(self, line):
+        self.socket.send(bytes(line, "UTF-8"))
+
+    def read(self):
+        buf = self.sock_buf
+        del buf[:]
+        chunk = memoryview(self.sock_chunk)
+        while True:
+            try:
+                data_len = self.socket.recv_into(chunk)
+            except OSError:
+                # nothing more within the socket timeout
+                break
+            if data_len == 0:
+                break
+            buf += chunk[:data_len]
+            # like on usb, a reply is complete once it ends with 0x0a
+            if buf[-1] == 10:
+                break
+        if len(buf) == 0:
+            return None
+        return buf.decode("UTF-8", "replace").upper().__repr__()
+
+    def close(self):
+        self.socket.close()
+        self.connected = False
+
+# ===== simulated TouchComm device =====
+# an in-process stand-in for an MPC04 with a TouchComm device behind it,
+# good enough to run flashing, config download and report streaming
+# without hardware. It follows what Comm2 sends and expects, it is not a
+# model of any particular firmware.
+
+SIM_FLASH_SIZE = 256 * 1024
+SIM_RAM_SIZE = 128 * 1024
+SIM_PAGE_SIZE = 4096
+
+# seconds from command to posted response
+SIM_COMMAND_LATENCY = {
+    '02': 0.0005,
+    '04': 0.05,
+    '11': 0.02,     # per page
+    '12': 0.001,
+    '13': 0.0005,
+    '14': 0.05,
+    '1f': 0.05,
+    '30': 0.005,
+    '81': 0.0002,
+}
+
+class SimTouchCommDevice:
+    def __init__(self, mode='app', latency=None, queue_depth=1,
+                 report_interval=0.01, report_shape=None, default_latency=0.0005):
+        self.mode = mode
+        self.flash = bytearray(b'\xff' * SIM_FLASH_SIZE)
+        self.ram = bytearray(SIM_RAM_SIZE)
+        self.config = {}
+        self.latency = dict(SIM_COMMAND_LATENCY)
+        if latency != None:
+            self.latency.update(latency)
+        self.default_latency = default_latency
+        # responses the device holds before answering 0x0D
+        self.queue_depth = queue_depth
+        self.pending = collections.deque() # (ready time, code, payload)
+        self.header_sent = False
+        self.long_cmd = None # [length, data, delay] of a 30 download
+        self.write_length = 0
+        self.report_id = None
+        self.report_interval = report_interval
+        self.next_report = 0
+        self.report_count = 0
+        if report_shape == None:
+            report_shape = (tx_cnt, rx_cnt)
+        cells = report_shape[0] * report_shape[1]
+        frame = array.array('h', ((i * 7) % 200 - 100 for i in range(cells)))
+        if sys.byteorder == 'big':
+            frame.byteswap()
+        self.report_frame = frame.tobytes()
+        self.commands = {
+            0x02: self.cmd_identify,
+            0x04: self.cmd_reset,
+            0x05: self.cmd_enable_report,
+            0x06: self.cmd_disable_report,
+            0x11: self.cmd_erase,
+            0x12: self.cmd_write_flash,
+            0x13: self.cmd_read_flash,
+            0x14: self.cmd_run_app,
+            0x1f: self.cmd_enter_bootloader,
+            0x30: self.cmd_download_config,
+            0x81: self.cmd_read_ram,
+        }
+
+    def identify_payload(self):
+        mode = 0x01 if self.mode == 'app' else 0x0c
+        # version, mode, part number, build id, max write size
+        return struct.pack('<BB16sLH', 2, mode, b'SIM', 1, 1024)
+
+    def post(self, code, payload=b'', delay=None):
+        self.pending.append((time.perf_counter() + (delay or 0), code, payload))
+
+    def write(self, data):
+        # one TouchComm write, code lenLo lenHi payload
+        if len(data) < 1:
+            return
+        code = data[0]
+        if self.long_cmd != None and code == 0x01:
+            # continuation packets carry no length
+            self.continue_long_cmd(data[1:])
+            return
+        payload = data[3:]
+        self.write_length = data[1] | data[2] << 8 if len(data) >= 3 else 0
+        if len(self.pending) >= self.queue_depth:
+            self.post(0x0d)
+            return
+        handler = self.commands.get(code)
+        if handler == None:
+            self.post(0x0e)
+            return
+        delay = self.latency.get('%02x' % code, self.default_latency)
+        handler(bytes(payload), delay)
+
+    def read(self, length):
+        # the bytes a rd=length would clock out
+        now = time.perf_counter()
+        if not self.pending and self.report_id != None and now >= self.next_report:
+            self.report_count = self.report_count + 1
+            self.pending.append((now, self.report_id, self.report_frame))
+            self.next_report = now + self.report_interval
+        if not self.pending or self.pending[0][0] > now:
+            return b'\xa5\x00\x00\x00'[:length]
+        ready, code, payload = self.pending[0]
+        if not self.header_sent:
+            self.header_sent = True
+            if not payload:
+                # nothing follows the header
+                self.pending.popleft()
+                self.header_sent = False
+            return struct.pack('<BBH', 0xA5, code, len(payload))[:length]
+        # A503 = continued read, 5A = end code
+        self.pending.popleft()
+        self.header_sent = False
+        return b'\xa5\x03' + payload[:length - 3] + b'\x5a'
+
+    def cmd_identify(self, payload, delay):
+        self.post(0x01, self.identify_payload(), delay)
+
+    def cmd_reset(self, payload, delay):
+        self.report_id = None
+        self.post(0x10, self.identify_payload(), delay)
+
+    def cmd_enter_bootloader(self, payload, delay):
+        self.mode = 'bl'
+        self.report_id = None
+        self.post(0x10, self.identify_payload(), delay)
+
+    def cmd_run_app(self, payload, delay):
+        self.mode = 'app'
+        self.post(0x10, self.identify_payload(), delay)
+
+    def host_download(self, data):
+        # the bridge pushed the firmware, boot it and ask for whatever
+        # config is still missing (0x04 app config, 0x02 display)
+        self.flash[0:len(data)] = data
+        self.mode = 'app'
+        delay = self.latency.get('14', self.default_latency)
+        self.post(0x10, self.identify_payload(), delay)
+        need = (0x04 if 0x01 not in self.config else 0) | (0x02 if 0x02 not in self.config else 0)
+        self.post(0x1b, bytes([need]), delay)
+
+    def cmd_enable_report(self, payload, delay):
+        if self.mode != 'app' or len(payload) < 1:
+            self.post(0x0f)
+            return
+        self.report_id = payload[0]
+        self.next_report = time.perf_counter() + delay
+        self.post(0x01, b'', delay)
+
+    def cmd_disable_report(self, payload, delay):
+        self.report_id = None
+        self.post(0x01, b'', delay)
+
+    def cmd_erase(self, payload, delay):
+        if self.mode != 'bl' or len(payload) < 2:
+            self.post(0x0f)
+            return
+        start = payload[0] * SIM_PAGE_SIZE
+        end = min(start + payload[1] * SIM_PAGE_SIZE, len(self.flash))
+        self.flash[start:end] = b'\xff' * (end - start)
+        self.post(0x01, b'', delay * max(payload[1], 1))
+
+    def cmd_write_flash(self, payload, delay):
+        if self.mode != 'bl' or len(payload) < 2:
+            self.post(0x0f)
+            return
+        start = struct.unpack_from('<H', payload)[0] * 8
+        data = payload[2:]
+        if start + len(data) > len(self.flash):
+            self.post(0x0f)
+            return
+        # like real flash, a write can only clear bits
+        old = int.from_bytes(self.flash[start:start + len(data)], 'little')
+        new = old & int.from_bytes(data, 'little')
+        self.flash[start:start + len(data)] = new.to_bytes(len(data), 'little')
+        self.post(0x01, b'', delay)
+
+    def cmd_read_flash(self, payload, delay):
+        if self.mode != 'bl' or len(payload) < 6:
+            self.post(0x0f)
+            return
+        word_addr, word_len = struct.unpack_from('<LH', payload)
+        self.post(0x01, bytes(self.flash[word_addr * 2:(word_addr + word_len) * 2]), delay)
+
+    def cmd_read_ram(self, payload, delay):
+        if len(payload) < 4:
+            self.post(0x0f)
+            return
+        # address and length are in 16-bit words
+        word_addr, word_len = struct.unpack_from('<HH', payload)
+        self.post(0x01, bytes(self.ram[word_addr * 2:(word_addr + word_len) * 2]), delay)
+
+    def cmd_download_config(self, payload, delay):
+        # the length of the first packet covers the continuations too
+        self.long_cmd = [self.write_length, bytearray(payload), delay]
+        self.finish_long_cmd()
+
+    def continue_long_cmd(self, payload):
+        self.long_cmd[1] += payload
+        self.finish_long_cmd()
+
+    def finish_long_cmd(self):
+        length, data, delay = self.long_cmd
+        if len(data) < length:
+            return
+        self.long_cmd = None
+        if length < 2:
+            self.post(0x0f)
+            return
+        # version, config type, config
+        self.config[data[1]] = bytes(data[2:length])
+        self.post(0x01, b'', delay)
+
+class SimTransport:
+    # speaks the MPC04 text protocol to a SimTouchCommDevice.
+    # link_latency is added to every line, like a USB round trip.
+    def __init__(self, device=None, link_latency=0):
+        if device == None:
+            device = SimTouchCommDevice()
+        self.device = device
+        self.link_latency = link_latency
+        self.replies = collections.deque()
+        self.base64 = False # set by base64=yes in a config line
+        self.hdl_data = bytearray() # image kept for host download
+        self.connected = True
+
+    def write(self, line):
+        if self.link_latency:
+            time.sleep(self.link_latency)
+        self.replies.append(self.handle(line.strip()))
+
+    def handle_hdl(self, fields):
+        # hdl crc at=0 size=N starts an image, hdl send idx=i data=...
+        # appends a chunk to it
+        args = dict(field.split('=', 1) for field in fields[2:] if '=' in field)
+        if fields[1:2] == ['crc']:
+            del self.hdl_data[:]
+        elif fields[1:2] == ['send']:
+            try:
+                if self.base64:
+                    self.hdl_data += base64.b64decode(args.get('data', ''))
+                else:
+                    self.hdl_data += bytes.fromhex(args.get('data', ''))
+            except ValueError:
+                return 'target=0 hdl err bad data\n'
+        return 'target=0 hdl ok\n'
+
+    def handle(self, line):
+        fields = line.split()
+        if len(fields) < 2 or fields[0] != 'target=0':
+            return 'err unknown command\n'
+        if fields[1] == 'hdl':
+            return self.handle_hdl(fields[1:])
+        if fields[1] == 'config':
+            self.base64 = 'base64=yes' in fields
+        if fields[1] != 'raw':
+            # config, power and the like
+            return line + ' ok\n'
+        wr = None
+        rd = None
+        for field in fields[2:]:
+            if field.startswith('wr='):
+                wr = field[3:]
+            elif field.startswith('rd='):
+                rd = field[3:]
+        if wr != None:
+            try:
+                data = bytes.fromhex(wr)
+            except ValueError:
+                return 'target=0 raw err bad hex\n'
+            if data[:1] == b'\x80':
+                # host download request register, 4B when the device
+                # waits for firmware
+                request = '4B' if self.device.mode == 'hdl' else '00'
+                return 'target=0 raw rd=1 data="%s"\n' % request
+            if data[:1] == b'\x00':
+                # bridge register writes, "wr=001c download" starts
+                # feeding the kept image to the device
+                if 'download' in fields and self.device.mode == 'hdl':
+                    self.device.host_download(bytes(self.hdl_data))
+                return 'target=0 raw ok\n'
+            self.device.write(data)
+            if rd == None:
+                return 'target=0 raw ok\n'
+        if rd == None:
+            return 'err unknown command\n'
+        try:
+            length = int(rd)
+        except ValueError:
+            return 'target=0 raw err bad length\n'
+        data = self.device.read(length)
+        return 'target=0 raw rd=%d data="%s"\n' % (length, data.hex().upper())
+
+    def read(self):
+        if self.link_latency:
+            time.sleep(self.link_latency)
+        if not self.replies:
+            return None
+        return self.replies.popleft()
+
+    def close(self):
+        self.connected = False
+
+# ===== link statistics =====
+# upper bounds (seconds) of the command latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# counters Comm2 bumps on its hot path, name -> help text
+STATS_COUNTERS = (
+    ('writes', 'lines written to the bridge'),
+    ('reads', 'replies read from the bridge'),
+    ('bytes_sent', 'bytes written to the bridge'),
+    ('bytes_received', 'bytes read from the bridge'),
+    ('empty_reads', 'reads that returned nothing'),
+    ('error_replies', 'replies the bridge flagged as an error'),
+    ('header_retries', 'rd=4 reads retried for lack of a packet'),
+    ('idle_polls', 'A5000000 polls while waiting for a response'),
+    ('flash_retries', 'flash blocks written again after a failure'),
+    ('link_errors', 'USB or socket errors that stopped a background reader'),
+)
+
+class CommStats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        for name, help in STATS_COUNTERS:
+            setattr(self, name, 0)
+        self.sleep_seconds = 0.0
+        # command code -> [count, total, max, timeouts, bucket counts]
+        self.commands = {}
+        self.start_time = time.time()
+
+    def command(self, cmd):
+        entry = self.commands.get(cmd)
+        if entry == None:
+            entry = [0, 0.0, 0.0, 0, [0] * (len(LATENCY_BUCKETS) + 1)]
+            self.commands[cmd] = entry
+        return entry
+
+    def record(self, cmd, seconds):
+        entry = self.command(cmd)
+        entry[0] = entry[0] + 1
+        entry[1] = entry[1] + seconds
+        entry[2] = max(entry[2], seconds)
+        entry[4][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def timeout(self, cmd):
+        self.command(cmd)[3] += 1
+
+    def mean_latency(self, cmd):
+        entry = self.commands.get(cmd)
+        if entry == None or entry[0] == 0:
+            return None
+        return entry[1] / entry[0]
+
+    def to_json(self):
+        result = dict((name, getattr(self, name)) for name, help in STATS_COUNTERS)
+        result['sleep_seconds'] = self.sleep_seconds
+        result['uptime_seconds'] = time.time() - self.start_time
+        commands = {}
+        for cmd, (count, total, longest, timeouts, buckets) in sorted(self.commands.items()):
+            bounds = ['%g' % b for b in LATENCY_BUCKETS] + ['+Inf']
+            commands[cmd] = {'count': count, 'seconds': total, 'max': longest,
+                             'timeouts': timeouts, 'buckets': dict(zip(bounds, buckets))}
+        result['commands'] = commands
+        return result
+
+    def prometheus(self, labels=None):
+        return prometheus_text([(labels or {}, self)])
+
+def prometheus_text(entries):
+    # text exposition format for [(labels, CommStats)], samples of one
+    # metric stay together as the format requires
+    def sample(name, labels, value, extra=''):
+        label = ''.join('%s="%s",' % item for item in sorted(labels.items())) + extra
+        if label:
+            return 'cdci_%s{%s} %s\n' % (name, label.rstrip(','), repr(value))
+        return 'cdci_%s %s\n' % (name, repr(value))
+    def header(name, help, kind):
+        return '# HELP cdci_%s %s\n# TYPE cdci_%s %s\n' % (name, help, name, kind)
+    out = []
+    for name, help in STATS_COUNTERS:
+        out.append(header(name + '_total', help, 'counter'))
+        for labels, stats in entries:
+            out.append(sample(name + '_total', labels, getattr(stats, name)))
+    out.append(header('sleep_seconds_total', 'time spent sleeping between polls', 'counter'))
+    for labels, stats in entries:
+        out.append(sample('sleep_seconds_total', labels, stats.sleep_seconds))
+    out.append(header('command_latency_seconds', 'command to response time', 'histogram'))
+    for labels, stats in entries:
+        for cmd, (count, total, longest, timeouts, buckets) in sorted(stats.commands.items()):
+            cumulative = 0
+            for bound, n in zip(LATENCY_BUCKETS + ('+Inf',), buckets):
+                cumulative = cumulative + n
+                le = bound if bound == '+Inf' else '%g' % bound
+                out.append(sample('command_latency_seconds_bucket', labels, cumulative, 'cmd="%s",le="%s",' % (cmd, le)))
+            out.append(sample('command_latency_seconds_sum', labels, total, 'cmd="%s",' % cmd))
+            out.append(sample('command_latency_seconds_count', labels, count, 'cmd="%s",' % cmd))
+    out.append(header('command_timeouts_total', 'commands that never posted a response', 'counter'))
+    for labels, stats in entries:
+        for cmd, entry in sorted(stats.commands.items()):
+            out.append(sample('command_timeouts_total', labels, entry[3], 'cmd="%s",' % cmd))
+    return ''.join(out)
+
+def plan_ram_reads(ranges, max_words=RAM_READ_MAX_WORDS, max_gap=RAM_READ_MAX_GAP):
+    # [(word_addr, word_len)] -> [(span_start, span_words, [(index,
+    # byte offset, byte size)])]. Sorted ranges that overlap or are at
+    # most max_gap words apart are merged into spans of at most
+    # max_words words, so each span is one 81 read.
+    plan = []
+    order = sorted(range(len(ranges)), key=lambda i: ranges[i])
+    i = 0
+    while i < len(order):
+        span_start = ranges[order[i]][0]
+        span_end = span_start + ranges[order[i]][1]
+        j = i + 1
+        while j < len(order):
+            addr, words = ranges[order[j]]
+            end = max(span_end, addr + words)
+            if addr - span_end > max_gap or end - span_start > max_words:
+                break
+            span_end = end
+            j = j + 1
+        parts = [(k, (ranges[k][0] - span_start) * 2, ranges[k][1] * 2) for k in order[i:j]]
+        plan.append((span_start, span_end - span_start, parts))
+        i = j
+    return plan
 
 class Comm2:
     def __init__(self,
@@ -215,14 +1083,20 @@ class Comm2:
                  busAddr=None,
                  vddh=3300,
                  vddio=1800,
-                 debug=False):
+                 debug=False,
+                 device=None,
+                 port=10001,
+                 transport=None):
 
         self.voltage = {"vled": vddh, "vdd": vddio, "vddtx": 1800, "vpu": 1800}
         self.interface = ip
-        #self.port = 10001 # for redremote
+        self.port = port # for redremote
         self.busAddr = busAddr
 
         self.retry = 5 # retry r/w times
+        self.stats = CommStats()
+        self.flash_progress = None # called with the byte count of each flash write
+        self.tag = None # put in front of flash status lines, e.g. "[adapter 0]"
         self.rmi_mode = False
         if self.interface == 'i2c':
             self.prefix = 'target=0 raw bus-addr={}'.format(self.busAddr)
@@ -231,52 +1105,17 @@ class Comm2:
 
         self.debug = debug
 
-        if self.interface == 'i2c' or self.interface == 'spi':
-            self.usb = usb.core.find(idVendor=0x06CB, idProduct=0x000F)
-            if self.usb is None:
-                print('Cannot connect to mpc04, make sure it\'s plugged in USB port.')
-                self.connected = False
-                return
-
-            self.out_endpoint_addr = 0x1
-            self.in_endpoint_addr = 0x82
-            self.usb.set_configuration()
-
-            # get an endpoint instance
-            cfg = self.usb.get_active_configuration()
-            intf = cfg[(0, 0)]
-            self.ep_in = usb.util.find_descriptor(
-              intf,
-              # match the first IN endpoint
-              custom_match= \
-                lambda e: \
-                  usb.util.endpoint_direction(e.bEndpointAddress) == \
-                  usb.util.ENDPOINT_IN)
-
-            if self.ep_in == None:
-                print("Error: USB endpoint_in Error")
-                self.connected = False
-                return
-
-            self.connected = True
-        else:
-             #===== initial socket =====
-            print("connect use red remote")
-            self.ip = bytes("127.0.0.1", 'utf-8')
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            try:
-                result = self.socket.connect((self.ip, 10001))
-            except:
-                self.connected = False
-                print(
-                    'Cannot connect to redremote server, make sure RedRemote is running.'
-                )
-                return
-             #設定recv的timeout時間
-            print("connect result", result)
-            self.socket.settimeout(0.2)
-            self.connected = True
-            pass
+        if transport == None:
+            if self.interface == 'i2c' or self.interface == 'spi':
+                transport = UsbTransport(device)
+            elif self.interface == 'sim':
+                transport = SimTransport()
+            else:
+                transport = SocketTransport('127.0.0.1', self.port)
+        self.transport = transport
+        self.connected = transport.connected
+        if not self.connected:
+            return
 
         # Init device
         self.DeviceInit()
@@ -299,25 +1138,23 @@ class Comm2:
             else:
                 print(command)
         command = command + '\n'
-
-        if self.interface == 'spi' or self.interface == 'i2c':
-            self.usb.write(self.out_endpoint_addr, command)
-        else:
-            cmd = bytes(command, "UTF-8")
-            self.socket.send(cmd)
+        self.transport.write(command)
+        self.stats.writes += 1
+        self.stats.bytes_sent += len(command)
 
         #time.sleep(0.01)
         read_error = 1
         while read_error > 0:
             read_str = self._usbRead()
             if read_str == None:
+                self.stats.empty_reads += 1
                 read_error = read_error - 1
                 #time.sleep(0.1)
                 #print("retry read in _usbWrite")
                 continue
             #print("in _usbWrite read_str", read_str)
-            r = re.search(r'err', read_str)
-            if r != None:
+            if 'err' in read_str:
+                self.stats.error_replies += 1
                 read_error = read_error - 1
                 #time.sleep(0.1)
                 #print("retry read in _usbWrite")
@@ -326,69 +1163,24 @@ class Comm2:
                 return read_str
         return read_str
 
-    def _usbRead(self):
-        if self.interface == 'spi' or self.interface == 'i2c':
-            buf = []
-            usb_read_retry_cnt = 1
-            while usb_read_retry_cnt > 0:
-                try:
-                    data=""
-                # 讀取第一次response (為了讓buf不是空的array)
-                    data = self.usb.read(self.in_endpoint_addr,
-                                         self.ep_in.wMaxPacketSize)
-                    if data == None or len(data) == 0:
-                        #print("retry usb read in _usbRead")
-                        #time.sleep(0.1)
-                        usb_read_retry_cnt = usb_read_retry_cnt - 1
-                        continue
-                #print("self.ep_in.wMaxPacketSize " , self.ep_in.wMaxPacketSize)
-                    break
-                except:               
-                    #print("retry usb read in _usbRead")
-                    #time.sleep(0.1)
-                    usb_read_retry_cnt = usb_read_retry_cnt - 1
-                    pass
-                
-            buf.extend(data)
-            if len(buf) == 0:
-                return None
-            # 檢查 response是否結束，以避免以下狀況 :
-            # 1_讀取速度太快，其中有幾次讀不到資料造成資料讀取不完整
-            # 2_該command會多次返回，例如 identify
-            # =====================================
-            # 10(0x0a) is end code of usb response,
-            # get 10(0x0a) means the response is complete
-            while buf[-1] != 10:
-                usb_read_retry_cnt = 1
-                while usb_read_retry_cnt > 0:
-                    try:
-                    # 讀取第一次response (為了讓buf不是空的array)
-                        data = self.usb.read(self.in_endpoint_addr,
-                                             self.ep_in.wMaxPacketSize)
-                    #print("self.ep_in.wMaxPacketSize " , self.ep_in.wMaxPacketSize)
-                        break
-                    except:
-                        usb_read_retry_cnt = usb_read_retry_cnt - 1
+    def log(self, *args):
+        if self.tag != None:
+            print(self.tag, *args)
+        else:
+            print(*args)
 
-                buf.extend(data)
+    def sleep(self, seconds):
+        self.stats.sleep_seconds += seconds
+        time.sleep(seconds)
 
-            # 把 hex-string 轉成 ascii
-            decode_packet = "".join(chr(item) for item in buf)
-            if self.debug:
-                print(decode_packet.strip())
-            return decode_packet
-        else:
-            result = []
-            while True:
-               try:
-                   result.append(self.socket.recv(4096).decode("UTF-8"))
-               except:
-                   break
-            result = ''.join(result).upper()
-            if self.debug:
-               print(result)
-            return result.__repr__()
-            pass
+    def _usbRead(self):
+        result = self.transport.read()
+        if result != None:
+            self.stats.reads += 1
+            self.stats.bytes_received += len(result)
+        if self.debug and result != None:
+            print(result.strip())
+        return result
 
     def autoScanI2CAddr(self):
         addrs = ['50', '20', '2c', '70', '4b', '67', '3c']
@@ -396,8 +1188,8 @@ class Comm2:
             self.prefix = 'target=0 raw bus-addr={}'.format(addr)
             result = self._usbWrite('{} wr=02'.format(self.prefix))
 
-            check = re.findall("err", result)
-            if check == []:
+            # no reply at all means nothing answered at this address
+            if result != None and result.strip() != '' and not parse_response(result).error:
                 print('Found I2C device at address 0x{}.'.format(addr))
                 self.busAddr = addr
                 break
@@ -439,7 +1231,7 @@ class Comm2:
                          vddtx=self.voltage['vddtx'])
 
             # wait for power-up
-            time.sleep(0.1)
+            self.sleep(0.1)
         else:
             #self.getDatabyCmd('02', '01')
             #self.socket.settimeout(0.05)
@@ -449,68 +1241,38 @@ class Comm2:
             #self.autoScanI2CAddr()
             self.busAddr = '20'
 
-    def printPacket(self, str):
+    def printPacket(self, packet):
         line_len = 32
 
-        if str == 'A5000000':
-            return
-        if str == None:
+        if packet == 'A5000000' or packet == IDLE_MESSAGE:
             return
-        if len(str) <= 8:
-            print(str)
+        if packet == None:
             return
+        if isinstance(packet, TcmMessage):
+            if packet.length == 0:
+                print(message_hex(packet))
+                return
+            header = struct.pack('<BBH', 0xA5, packet.code, packet.length)
+            payload = packet.payload
         else:
-            data = [int(str[index:index + 2], 16) for index in range(0, len(str), 2)]
-            print('Header={}, Length={}'.format(str[0:8], data[2] | data[3] << 8))
-
-        
-        data_len = data[2] | data[3] << 8;
-        if data_len == 36 * 16 * 2 or data_len == 36 * 18 * 2 or data_len == 34 * 15 * 2:
-            if data_len == 36 * 16 * 2:
-                rows = 36
-                cols = 16
-            elif data_len == 36 * 18 * 2:
-                rows = 36
-                cols = 18
-            else:
-                rows = 34
-                cols = 15
-            index = 0
-            print('r\c:', end='')
-            for col in range(0, cols):
-                print('{:4d} '.format(col), end='')
-            print("")
-            print("")
-            for row in range(0,rows):
-                print("%2d: " % row, end="")
-                for col in range(0, cols):
-                    tp_data = (ct.c_int16(data[4 + index] | data[4 + index + 1] << 8)).value
-                    index = index + 2
-                    print('{:4d} '.format(tp_data), end='')
-                print("")
+            if len(packet) <= 8:
+                print(packet)
+                return
+            header = bytes.fromhex(packet[0:8])
+            payload = bytes.fromhex(packet[8:])
+        data_len = header[2] | header[3] << 8
+        print('Header={}, Length={}'.format(header.hex().upper(), data_len))
+
+        shape = frame_shape(data_len)
+        if shape != None:
+            rows, cols = shape
+            sys.stdout.write(format_frame(decode_frame(payload), rows, cols) + '\n')
         else:
-            print("     ", end="")
-            for i in range(0, line_len):
-                print('{:02d} '.format(i), end='')
-
-            data = data[4:]
-            address = 0
-            for index, item in enumerate(data):
-                if index % line_len == 0:
-                    print('\n{:04d}:'.format(address), end='')
-                    address = address + line_len
-                print('{:02X} '.format(item), end='')
-        print('')
-
+            sys.stdout.write(format_hex_dump(payload, line_len) + '\n')
     def sendCmd(self, cmd, needResponse=False, response=None):
         ret = ''
         if cmd != '':
             ret = self._usbWrite('{} {}'.format(self.prefix, cmd))
-            if self.interface == "red":
-                r = re.search(r'WR COUNT', ret)
-                #read out the seq msg
-                #seq = self.socket.read(1024)
-                
             if needResponse:
                 while True:
                     ret = self.getResponse()
@@ -530,25 +1292,27 @@ class Comm2:
                 if ret == None:
                     print("no usb response return None")
                     return ret
-                r = re.search(r'"A5\S+"', ret)
-                if r == None:
+                ret = parse_response(ret).hex
+                if ret == None:
                     return None
-                else:
-                    r = r.group().strip()
-                    ret = re.sub('"', '', r)
         self.printPacket(ret)
         return ret
     def sendCmd_cmd_data(self, cmd, data=None):
+        # data is either a hex string or the payload bytes
         ret = ''
         if cmd != '':
             if data == None:
                 data_len = 0;
                 data_str = ""
-            else:
+            elif isinstance(data, str):
                 data_len = len(data) // 2
                 data_str = data
+            else:
+                data_len = len(data)
+                data_str = data.hex()
             cmd_cdci = 'wr=' + cmd + "%02x%02x" % (data_len % 256, data_len // 256) + data_str
-            print(cmd_cdci)
+            if self.debug:
+                print(cmd_cdci)
             ret = self._usbWrite('{} {}'.format(self.prefix, cmd_cdci))
         return ret
     def send_raw_data(self, cmd, data=None):
@@ -561,114 +1325,97 @@ class Comm2:
                 data_len = len(data) // 2
                 data_str = data
             cmd_cdci = 'wr=' + cmd  + data_str
-            print(cmd_cdci)
+            if self.debug:
+                print(cmd_cdci)
             ret = self._usbWrite('{} {}'.format(self.prefix, cmd_cdci))
         return ret
 
-    def readMsg(self):
-        str1 = ''
-        str2 = ''
+    def read_message(self):
+        # next TouchComm message as a TcmMessage, None if the bridge
+        # never returned a packet
         retry_read_msg_cnt = 10
         while retry_read_msg_cnt > 0:
-            if "red" == self.interface and False:
-                r = self._usbWrite('{} rd=4'.format(self.prefix))
-                print(msg)
-                return
-            else:
             # ===== Get data-length =====
-                r = self._usbWrite('{} rd=4'.format(self.prefix))
-                #print("read from device r " + r)
-                # ===== check and make sure startCode is correct =====
-                r = re.search(r'"A5\S+"', r)
-                if r == None:
-                    #error msg, should read again
-                    retry_read_msg_cnt = retry_read_msg_cnt - 1
-                    time.sleep(0.1)
-                    continue
-                    #should read again? no need _usbwrite already do the retry
-                    #return None
-                else:
-                    r = r.group().strip()
-                    r = re.sub('"', '', r)
-                    if r == 'A5000000':
-                        #idle retry read
-                        #retry_read_msg_cnt = retry_read_msg_cnt - 1
-                        #continue
-                        return r
-                    break
-        str1 = r
-        str2 = ''
-        length = 3 + int(r[4:6], 16) | int(r[6:], 16) << 8
-        if length > 3:
-            # ===== Get real data =====
-            r = self._usbWrite('{} rd={}'.format(self.prefix, length))
-            try:
-                # A503 = Continues Read
-                data = re.search(r'"A503\S+5A"', r).group().strip()
-
-                # Strip " string at begin and end, then remove A5(startCode)、03(ContinueReadCode)、5A(endCode)
-                data = re.sub('"', '', data)[4:-2]
-                str2 = data
-            except:
-                assert False, "ERROR: can't get complete data : {}".format(r)
-        return str1 + str2
+            r = self._usbWrite('{} rd=4'.format(self.prefix))
+            # ===== check and make sure startCode is correct =====
+            packet = parse_response(r).packet
+            if packet != None and len(packet) >= 4:
+                break
+            #error msg, should read again
+            retry_read_msg_cnt = retry_read_msg_cnt - 1
+            self.stats.header_retries += 1
+            self.sleep(0.1)
+        else:
+            return None
+        code = packet[1]
+        length = packet[2] | packet[3] << 8
+        if length == 0:
+            if code == 0:
+                return IDLE_MESSAGE
+            return TcmMessage(code, 0, b'')
+        # ===== Get real data =====
+        r = self._usbWrite('{} rd={}'.format(self.prefix, length + 3))
+        data = parse_response(r).packet
+        # A503 = Continues Read, 5A = endCode
+        if data == None or data[0:2] != b'\xa5\x03' or data[-1:] != b'\x5a':
+            assert False, "ERROR: can't get complete data : {}".format(r)
+        return TcmMessage(code, length, data[2:-1])
+    def readMsg(self):
+        # hex text of the next message, for printing and the REPL
+        msg = self.read_message()
+        if msg == None:
+            return None
+        return message_hex(msg)
     def read_msg_bytes(self):
-        retry_cnt = 3
+        return self.wait_response(None, 0.3)
+    def wait_response(self, cmd, timeout=None):
+        # poll until the device leaves idle (A5000000), backing off
+        # exponentially, give up after the command's timeout. The first
+        # poll waits for half the latency seen so far for this command.
+        table_timeout = COMMAND_TIMEOUTS.get(cmd and cmd.lower(), DEFAULT_COMMAND_TIMEOUT)
+        if timeout == None:
+            timeout = table_timeout
+        start_time = time.time()
+        latency = self.stats.mean_latency(cmd)
+        if latency != None:
+            self.sleep(latency / 2)
+        interval = POLL_FIRST_INTERVAL
         while True:
-            response=self.readMsg()
-            if response == 'A5000000':
-                retry_cnt = retry_cnt - 1
-                if retry_cnt:
-                    time.sleep(0.1)
-                    continue
-                else:
-                    break
-            else:
+            msg = self.read_message()
+            if msg == None:
+                msg = IDLE_MESSAGE
+            elapsed = time.time() - start_time
+            if msg != IDLE_MESSAGE or elapsed >= timeout:
                 break
-        response_code = int(response[2:4],16)
-        response_data_len = int(response[4:6],16) + int(response[6:8],16) * 256
-        response_data = []
-        for i in range(response_data_len):
-            index = 8 + i * 2
-            response_data.append(int(response[index:index+2],16))
-        return response_code,response_data_len,response_data
+            self.stats.idle_polls += 1
+            self.sleep(interval)
+            interval = min(interval * 2, POLL_MAX_INTERVAL)
+        if cmd != None:
+            if msg != IDLE_MESSAGE:
+                self.stats.record(cmd, elapsed)
+            else:
+                self.stats.timeout(cmd)
+        return msg
 
+    def drain_responses(self, cmd):
+        # throw away responses still on their way after cmd timed out
+        timeout = COMMAND_TIMEOUTS.get(cmd.lower(), DEFAULT_COMMAND_TIMEOUT)
+        while self.wait_response(None, timeout) != IDLE_MESSAGE:
+            pass
     def write_cmd_and_read_back(self, cmd, data=None, sleep_time=None):
+        # sleep_time is how long the caller is willing to wait, the
+        # response is read as soon as it is posted
         self.sendCmd_cmd_data(cmd, data)
-        if sleep_time == None:
-            sleep_time = NORMAL_SLEEP_TIME
-        time.sleep(sleep_time)
-        retry_cnt = 3
-        while True:
-            response=self.readMsg()
-            if response == 'A5000000':
-                retry_cnt = retry_cnt - 1
-                if retry_cnt:
-                    time.sleep(0.1)
-                    continue
-                else:
-                    break
-            else:
-                break
-        response_code = int(response[2:4],16)
-        response_data_len = int(response[4:6],16) + int(response[6:8],16) * 256
-        response_data = []
-        for i in range(response_data_len):
-            index = 8 + i * 2
-            response_data.append(int(response[index:index+2],16))
-        return response_code,response_data_len,response_data
-    def write_cmd_and_read_back_check(self, cmd, data=None, sleep_time=None):
-        response_code,response_data_len,response_data = self.write_cmd_and_read_back(cmd,data,sleep_time)
-        if (response_code == 1) or (response_code == 0):
-            return True
-        return False
+        if sleep_time != None:
+            sleep_time = max(sleep_time, COMMAND_TIMEOUTS.get(cmd.lower(), DEFAULT_COMMAND_TIMEOUT))
+        return self.wait_response(cmd, sleep_time)
     def getResponse(self):
         while True:
             r = self.readMsg()
             if r == 'A5000000':
                 self.retry = self.retry - 1
                 if self.retry:
-                    time.sleep(0.01)
+                    self.sleep(0.01)
                     continue
                 else:
                     break
@@ -685,231 +1432,1009 @@ class Comm2:
             return "bl"
         return "unknown" 
     def getDatabyCmd(self, cmdCode, statusCode):
-        msg = 'A5{}'.format(statusCode)
-        retry = 10
+        status = int(statusCode, 16)
         self._usbWrite('{} wr={}0000'.format(self.prefix, cmdCode))
         while True:
-            time.sleep(0.01)
-            r = self.readMsg()
-            if r == 'A5000000':
-                time.sleep(0.01)
-                retry = retry - 1
-                if (retry == 0):
-                    return None
-                continue
-            elif r == None:
-                continue
-            elif msg == r[0:4]:
+            msg = self.wait_response(cmdCode)
+            if msg == IDLE_MESSAGE:
+                return None
+            elif msg.code == status:
                 break
-        #print(r)
-        r = r[8:]
-        data = [int(r[index:index + 2], 16) for index in range(0, len(r), 2)]
-        return data
-    def writeLongCmd(self, cmd, write_data, data_len):
-            #print(type(write_data),data_len)
-            write_chunk_size = 256
-            remaining_size = data_len
-            offset = 0
-            write_cmd_cnt = 0
-            first_send = True
-            data_str = write_data
-            while remaining_size > 0:
-                if remaining_size > 256:
-                    data_size = write_chunk_size
-                else:
-                    data_size = remaining_size
-                
-                if first_send == True:
-                    cmd_code = cmd
-                    data_size = 254
-                    first_send = False
-                    send_cmd_str = "%02x" % int(data_len % 256) + "%02x" % int(data_len // 256) + data_str[offset*2:offset*2 + data_size*2]
-                else:
-                    cmd_code = "01"
-                    send_cmd_str = data_str[offset*2:offset*2 + data_size*2]
-                remaining_size = remaining_size - data_size
-                offset = offset + data_size
-                #print(flash_cmd_str)
-                #code, length, data=self.write_cmd_and_read_back("12", flash_cmd_str, 0.1)
-                write_cmd_cnt = write_cmd_cnt + 1
-                self.send_raw_data(cmd_code, send_cmd_str)
+        return msg.payload
+    def writeLongCmd(self, cmd, write_data, data_len=None):
+        # write_data is the payload as bytes (hex text is still taken).
+        # The first packet carries the length and 254 bytes, the rest
+        # follow as 01 continuation packets of 256 bytes; each chunk is
+        # hex encoded once, straight from a view of the payload.
+        if isinstance(write_data, str):
+            write_data = bytes.fromhex(write_data)
+        data_view = memoryview(write_data).cast('B')
+        if data_len == None:
+            data_len = data_view.nbytes
+        first_chunk_size = 254
+        write_chunk_size = 256
+        self.send_raw_data(cmd, struct.pack('<H', data_len).hex() + data_view[:first_chunk_size].hex())
+        for offset in range(first_chunk_size, data_len, write_chunk_size):
+            self.send_raw_data("01", data_view[offset:min(offset + write_chunk_size, data_len)].hex())
+        if self.debug:
             print("send long cmd done, about to read")
-            time.sleep(0.2)
-            self.readMsg()
+        return self.wait_response(cmd)
     def download_config(self, config_type, config_data, config_len):
-        version_str = "01"
-        config_data_str = ""
+        # config_data is a list of byte values or any byte buffer, it is
+        # copied once into the command payload and left as it was
+        if isinstance(config_data, list):
+            config = bytes(config_data[:config_len])
+        else:
+            config = memoryview(config_data).cast('B')[:config_len]
         if config_type == "app":
-            config_type_str = "01"
-            if (config_len < 4096):
-                for i in range(config_len, 4096):
-                    config_data.append(0)
-            config_len = 4096
+            config_type_code = 0x01
         elif config_type == "disp":
-            config_type_str = "02"
-        for i in range(0, config_len):
-            config_data_str = config_data_str + "%02x" % config_data[i]
-        raw_data = version_str + config_type_str + config_data_str
-        self.writeLongCmd("30", raw_data, len(raw_data) // 2)
-    def writeFlash(self, flash_addr, flash_data, flash_data_size):
-        write_chunk_size = 512
+            config_type_code = 0x02
+        # version, config type, config
+        raw_data = bytearray((0x01, config_type_code))
+        raw_data += config
+        if config_type == "app" and len(config) < 4096:
+            # app config always goes down as 4096 bytes
+            raw_data += bytes(4096 - len(config))
+        return self.writeLongCmd("30", raw_data, len(raw_data))
+    def flash_chunk(self, flash_view, flash_addr, offset, data_size):
         block_size = 8
-        remaining_size = flash_data_size
-        offset = 0
-        write_cmd_cnt = 0
-        data_str = ""
-        a = True
-        block_addr_low = 0
-        block_addr_high = 0
-        while remaining_size > 0:
-            if remaining_size > 512:
-                data_size = write_chunk_size
-            else:
-                data_size = remaining_size
-            remaining_size = remaining_size - data_size
-            block_addr = int((flash_addr + offset) / block_size)
-            block_addr_low = int(block_addr % 256)
-            block_addr_high = int(block_addr / 256)
-            data_str = ""
-            for i in range(0,data_size):
-                data_str += "%02x" % flash_data[offset + i]
-            flash_write_cmd_data= "%02x" % block_addr_low + "%02x" % block_addr_high + data_str
-            #flash_write_cmd_data_len = data_size + 2
-            flash_cmd_str = flash_write_cmd_data
-            offset = offset + data_size
-            #print(flash_cmd_str)
-            code, length, data=self.write_cmd_and_read_back("12", flash_cmd_str, 0.1)
-            write_cmd_cnt = write_cmd_cnt + 1
-            if code != 0x01:
-                print("write flash fail", write_cmd_cnt, offset, data_size, block_addr_high, block_addr_low)
-                return False
-        #print(write_cmd_cnt)
+        block_addr = (flash_addr + offset) // block_size
+        return struct.pack('<H', block_addr) + flash_view[offset:offset + data_size]
+    def writeFlash(self, flash_addr, flash_data, flash_data_size, window=1):
+        write_chunk_size = 512
+        flash_view = memoryview(flash_data)
+        chunks = [(offset, min(write_chunk_size, flash_data_size - offset))
+                  for offset in range(0, flash_data_size, write_chunk_size)]
+        start_time = time.time()
+        if window <= 1:
+            for write_cmd_cnt, (offset, data_size) in enumerate(chunks, 1):
+                flash_cmd_str = self.flash_chunk(flash_view, flash_addr, offset, data_size)
+                code, length, data=self.write_cmd_and_read_back("12", flash_cmd_str)
+                if code != 0x01:
+                    block_addr = (flash_addr + offset) // 8
+                    self.log("write flash fail", write_cmd_cnt, offset + data_size, data_size, block_addr // 256, block_addr % 256)
+                    return False
+                if self.flash_progress != None:
+                    self.flash_progress(data_size)
+        else:
+            failed = []
+            i = 0
+            while i < len(chunks):
+                batch = chunks[i:i + window]
+                i = i + len(batch)
+                # put the whole window on the link before collecting responses
+                for offset, data_size in batch:
+                    self.sendCmd_cmd_data("12", self.flash_chunk(flash_view, flash_addr, offset, data_size))
+                # responses come back in the order the blocks were sent
+                for n, (offset, data_size) in enumerate(batch):
+                    code, length, data = self.wait_response("12")
+                    if code == 0x01:
+                        if self.flash_progress != None:
+                            self.flash_progress(data_size)
+                        continue
+                    failed.append((offset, data_size))
+                    if code == 0x0d and window > 1:
+                        # the device can't hold the window, go one at a time
+                        self.log("write flash: device busy, window %d -> 1" % window)
+                        window = 1
+                    if code == 0x00:
+                        # timed out, a late response would be taken for
+                        # the next block's
+                        failed.extend(batch[n + 1:])
+                        self.drain_responses("12")
+                        break
+            if failed:
+                self.log("write flash: %d of %d blocks failed, retry them" % (len(failed), len(chunks)))
+            for offset, data_size in failed:
+                flash_cmd_str = self.flash_chunk(flash_view, flash_addr, offset, data_size)
+                for retry in range(3):
+                    self.stats.flash_retries += 1
+                    code, length, data = self.write_cmd_and_read_back("12", flash_cmd_str)
+                    if code == 0x01:
+                        if self.flash_progress != None:
+                            self.flash_progress(data_size)
+                        break
+                    if code == 0x00:
+                        self.drain_responses("12")
+                else:
+                    self.log("write flash fail at block 0x%x" % ((flash_addr + offset) // 8))
+                    return False
+        elapsed = time.time() - start_time
+        if elapsed > 0:
+            self.log("write flash %d bytes in %.2fs, %.0f bytes/s" % (flash_data_size, elapsed, flash_data_size / elapsed))
         return True
     def getStaticCfg(self):
         return self.getDatabyCmd(cmdCode='21', statusCode='01')
-    def update_firmware(self):
-        app_address = 0
-        app_data = ""
-        app_length = 0
-        app_config_address = 0
-        app_config_data = ""
-        app_config_length = 0
-        disp_address = 0
-        disp_data = ""
-        disp_length = 0
-        global img_file_path
-        if img_file_path == None:
-            print("img file path", img_file_path)
-            print("no img file path, return")
-            return
-        img = TouchBootImageFile.load(img_file_path) 
-        for i in range(len(img.flashAreas)):
-            if (img.flashAreas[i]['name'] == 'APP_CODE'):
-                app_address = img.flashAreas[i]['address']
-                app_data = img.flashAreas[i]['data']
-                app_length = img.flashAreas[i]['length']                
-                #print(app_address, app_data, app_length)
-            if (img.flashAreas[i]['name'] == 'APP_CONFIG'):           
-                app_config_address = img.flashAreas[i]['address']
-                app_config_data = img.flashAreas[i]['data']
-                app_config_length = img.flashAreas[i]['length']                
-                #print(app_config_address, app_config_data, app_config_length)
-            if (img.flashAreas[i]['name'] == 'DISPLAY'):           
-                disp_address = img.flashAreas[i]['address']
-                disp_data = img.flashAreas[i]['data']
-                disp_length = img.flashAreas[i]['length']
+    def readFlash(self, flash_addr, length):
+        # address and length go to the bootloader in 16-bit words
+        code, data_len, data = self.write_cmd_and_read_back("13", struct.pack('<LH', flash_addr // 2, length // 2))
+        if code != 0x01:
+            return None
+        return data
+    def readRam(self, word_addr, word_len):
+        # address and length are in 16-bit words
+        code, data_len, data = self.write_cmd_and_read_back("81", struct.pack('<HH', word_addr, word_len))
+        if code != 0x01:
+            return None
+        return data
+    def read_ram_batch(self, ranges, max_words=RAM_READ_MAX_WORDS, max_gap=RAM_READ_MAX_GAP):
+        # [(word_addr, word_len)] -> the bytes of each range, None where
+        # the read failed
+        return self.read_ram_plan(plan_ram_reads(ranges, max_words, max_gap), len(ranges))
+    def read_ram_plan(self, plan, count):
+        # one 81 command per span of a plan_ram_reads plan
+        results = [None] * count
+        for span_start, span_words, parts in plan:
+            data = self.readRam(span_start, span_words)
+            if data != None:
+                for k, offset, size in parts:
+                    results[k] = data[offset:offset + size]
+        return results
+    def changed_pages(self, flash_addr, flash_data, length, page_size=2048 * 2):
+        flash_view = memoryview(flash_data)
+        pages = []
+        for page, start in enumerate(range(0, length, page_size)):
+            size = min(page_size, length - start)
+            if self.readFlash(flash_addr + start, size) != flash_view[start:start + size]:
+                pages.append(page)
+        return pages
+    def update_flash_area(self, name, address, data, length, erase_time, window=1, delta=False):
         page_size = 2048 * 2
-        write_block_size = 4 * 2
-        app_start_page = int(app_address * 2 / page_size)
-        app_page_cnt = int((app_length / page_size))
-        if (app_length  % page_size):
-            app_page_cnt = app_page_cnt + 1
-        app_config_start_page = int(app_config_address * 2 / page_size)
-        app_config_page_cnt = int((app_config_length / page_size))
-        if (app_config_length % page_size):
-            app_config_page_cnt = app_config_page_cnt + 1
-        disp_config_start_page = int(disp_address * 2 / page_size)
-        disp_config_page_cnt = int((disp_length / page_size))
-        if (disp_length  % page_size):
-            disp_config_page_cnt = disp_config_page_cnt + 1
-        print(app_start_page, app_page_cnt,app_config_start_page,app_config_page_cnt,disp_config_start_page,disp_config_page_cnt)
-        #erase app
-        
-        erase_cmd_data_str = '%02x%02x' % (app_start_page, app_page_cnt)
-        print(erase_cmd_data_str)        
-        if self.write_cmd_and_read_back_check('11',erase_cmd_data_str, 8):
-            print("erase app OK")
-            if self.writeFlash(app_address * 2, app_data, app_length):
-                print("update app OK")
-            else:            
-                print("update app fail")
-                return
+        start_page = address * 2 // page_size
+        page_cnt = (length + page_size - 1) // page_size
+        if delta:
+            pages = self.changed_pages(address * 2, data, length, page_size)
+            self.log("%s: %d of %d pages changed" % (name, len(pages), page_cnt))
         else:
-            print("erase app fail")
-            return
-            #print("erase app OK")
-        
-        erase_cmd_data_str = '%02x%02x' % (app_config_start_page, app_config_page_cnt)
-        print(erase_cmd_data_str)        
-        if self.write_cmd_and_read_back_check('11',erase_cmd_data_str, 1):
-            print("erase app config OK")
-            if self.writeFlash(app_config_address * 2, app_config_data, app_config_length):
-                print("update app config OK")
-            else:            
-                print("update app config fail")
-                return
-        else:
-            print("erase app config fail")
-            return
-
-        erase_cmd_data_str = '%02x%02x' % (disp_config_start_page, disp_config_page_cnt)
-        print(erase_cmd_data_str)        
-        if self.write_cmd_and_read_back_check('11',erase_cmd_data_str, 1):
-            print("erase app config OK")
-            if self.writeFlash(disp_address * 2, disp_data, disp_length):
-                print("update disp config OK")
-            else:            
-                print("update disp config fail")
-                return
-        else:
-            print("erase disp config fail")
-            return
-        print("update firmware OK!!!!!!!!!!!!!!!!")
-        print("about to switch to app firmware")
+            pages = list(range(page_cnt))
+        data_view = memoryview(data)
+        # erase and write each run of consecutive pages in one go
+        i = 0
+        while i < len(pages):
+            first = pages[i]
+            cnt = 1
+            while i + cnt < len(pages) and pages[i + cnt] == first + cnt:
+                cnt = cnt + 1
+            i = i + cnt
+            erase_cmd_data = bytes([start_page + first, cnt])
+            self.log(erase_cmd_data.hex())
+            code, data_len, response_data = self.write_cmd_and_read_back('11', erase_cmd_data, erase_time)
+            if code != 0x01 and code != 0x00:
+                self.log("erase %s fail" % name)
+                return False
+            self.log("erase %s OK" % name)
+            start = first * page_size
+            end = min(length, (first + cnt) * page_size)
+            if not self.writeFlash(address * 2 + start, data_view[start:end], end - start, window):
+                self.log("update %s fail" % name)
+                return False
+        self.log("update %s OK" % name)
+        return True
+    def update_firmware(self, window=1, delta=False, img=None):
+        global img_file_path
+        if img == None:
+            if img_file_path == None:
+                self.log("img file path", img_file_path)
+                self.log("no img file path, return")
+                return False
+            img = TouchBootImageFile.load(img_file_path)
+        for name, area_name, erase_time in (("app", 'APP_CODE', 8),
+                                            ("app config", 'APP_CONFIG', 1),
+                                            ("disp config", 'DISPLAY', 1)):
+            area = img.getFlashArea(area_name)
+            if area is None:
+                continue
+            if not self.update_flash_area(name, area.address, area.data, area.length, erase_time, window, delta):
+                return False
+        self.log("update firmware OK!!!!!!!!!!!!!!!!")
+        self.log("about to switch to app firmware")
         app_bl_mode = self.getDeviceMode()
         if "ap" == app_bl_mode:
-            print("switch to app firmware ok")
+            self.log("switch to app firmware ok")
         elif "bl" == app_bl_mode:
             response_code,response_data_len,response_data = self.write_cmd_and_read_back("14")
             if response_code == 0x10 and response_data[1] == 0x01 or response_code == 0x0:
-                print("switch to app firmware ok")
+                self.log("switch to app firmware ok")
+        return True
+    def flash_image(self, img=None, window=1, delta=False):
+        # enter the bootloader if needed, then update_firmware
+        device_mode = self.getDeviceMode()
+        if device_mode == "app":
+            code,len_bytes,data=self.write_cmd_and_read_back('1f')
+            if code != 0x10:
+                self.log("enter bl NG")
+                return False
+            if data[1] == 0xc:
+                self.log("enter bl OK")
+            else:
+                self.log("enter bl NG")
+        if device_mode == "unknown":
+            return False
+
+        # a delta update erases only the pages that differ, pre-erasing
+        # would make pages 8-15 look changed
+        if not delta:
+            code,len_bytes,data = self.write_cmd_and_read_back('11','0808', 1)
+            if code == 0x01:
+                self.log("erase ok")
+            else:
+                self.log("erase NG")
+                return False
+        return self.update_firmware(window, delta, img)
+    def host_download(self, img=None, chunk_size=HDL_CHUNK_SIZE, use_base64=True):
+        # for a device that boots without firmware and asks the host
+        # for it. APP_CODE goes to the bridge in chunk_size pieces,
+        # base64 (or hex) encoded, then the bridge feeds it to the
+        # device. Config areas follow if the firmware asks for them.
+        # The bridge goes back to its normal Config() afterwards.
+        global img_file_path
+        loaded = False
+        if img == None:
+            if img_file_path == None:
+                print("no img file path, return")
+                return False
+            img = TouchBootImageFile.load(img_file_path, lazy=True)
+            loaded = True
+        try:
+            ok = self.download_app_code(img, chunk_size, use_base64)
+        finally:
+            self.Config()
+        # on an exception the traceback still holds views into the
+        # mapping, the image is closed when it is collected
+        if loaded:
+            img.close()
+        return ok
+    def download_app_code(self, img, chunk_size, use_base64):
+        area = img.getFlashArea('APP_CODE')
+        if area is None:
+            print("no APP_CODE in the image, return")
+            return False
+        app_code = TouchBootImageFile.areaBytes(area.data)[:area.length]
+        app_code_len = len(app_code)
+
+        # the device puts 4B in 8000 while it waits for firmware
+        r = None
+        for retry in range(10):
+            hdl_request = self._usbWrite("{} wr=8000 rd=1".format(self.prefix))
+            if hdl_request == None:
+                continue
+            r = MPC04_DATA.search(hdl_request)
+            if r != None:
+                break
+        if r == None or r.group(1) != '4B':
+            print("not request fw, return")
+            return False
+
+        start_time = time.time()
+        if use_base64:
+            self._usbWrite(HDL_SPI_CONFIG + " base64=yes")
+        else:
+            self._usbWrite(HDL_SPI_CONFIG)
+        self._usbWrite("target=0 hdl crc at=0 size=%d" % app_code_len)
+        wire_bytes = 0
+        for idx, offset in enumerate(range(0, app_code_len, chunk_size)):
+            chunk = app_code[offset:offset + chunk_size]
+            if use_base64:
+                chunk_str = base64.b64encode(chunk).decode('ascii')
+            else:
+                chunk_str = chunk.hex()
+            wire_bytes = wire_bytes + len(chunk_str)
+            self._usbWrite("target=0 hdl send idx=%d data=%s" % (idx, chunk_str))
+        self._usbWrite("target=0 asic reset level=low output=open-drain time=1000")
+        self._usbWrite("{} wr=001804".format(self.prefix))
+        self._usbWrite("{} wr=001c download at=0 size={}".format(self.prefix, app_code_len))
+
+        code, length, data = self.wait_response('hdl')
+        if code != 0x10:
+            print("download app fail, response 0x%02x" % code)
+            return False
+        elapsed = time.time() - start_time
+        print("download app ok, %d bytes (%d on the wire) in %.2fs, %.0f bytes/s" % (
+            app_code_len, wire_bytes, elapsed, app_code_len / elapsed if elapsed else 0))
+
+        code, length, data = self.read_msg_bytes()
+        if code == 0x1b and length > 0:
+            print("need to download app_config display_config", data[0] & 0x04, data[0] & 0x02)
+            for need, config_type, area_name in ((0x04, "app", 'APP_CONFIG'), (0x02, "disp", 'DISPLAY')):
+                area = img.getFlashArea(area_name)
+                if data[0] & need and area != None:
+                    print("download %s config" % config_type)
+                    self.download_config(config_type, TouchBootImageFile.areaBytes(area.data), area.length)
+        if self.getDeviceMode() != "app":
+            print("host download fail")
+            return False
+        print("host download success")
+        return True
     def clearCmd(self):
         while True:
             r = self._usbWrite('{} rd=4'.format(self.prefix))
             if self.debug:
                 print(r)
-            status = re.search('"A5000000"', r)
-            if status == None:
-                pass
-            else:
+            if parse_response(r).hex == 'A5000000':
                 break
 
     def Quit(self):
-        if self.interface == 'i2c' or self.interface == 'spi':
-            #self.PowerOff()
-            if self.usb is not None:
-                usb.util.dispose_resources(self.usb)
-            self.connected = False
+        #self.PowerOff()
+        self.transport.close()
+        self.connected = False
+
+
+def find_adapters():
+    # every MPC04 on the bus
+    return list(usb.core.find(find_all=True, idVendor=0x06CB, idProduct=0x000F))
+
+class AsyncComm2:
+    # asyncio front end for one adapter. pyusb and the RedRemote socket
+    # block, so every call runs on the adapter's own worker thread; one
+    # thread per adapter also keeps its transactions in order while
+    # different adapters run at the same time.
+    def __init__(self, comm, executor):
+        self.comm = comm
+        self.executor = executor
+
+    @classmethod
+    async def open(cls, **kwargs):
+        # kwargs go to Comm2, which also runs DeviceInit
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        loop = asyncio.get_running_loop()
+        try:
+            comm = await loop.run_in_executor(executor, functools.partial(Comm2, **kwargs))
+        except BaseException:
+            executor.shutdown(wait=False)
+            raise
+        return cls(comm, executor)
+
+    async def call(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+
+    async def send(self, cmd, data=None):
+        return await self.call(self.comm.sendCmd_cmd_data, cmd, data)
+
+    async def read(self):
+        return await self.call(self.comm.read_message)
+
+    async def command(self, cmd, data=None, timeout=None):
+        return await self.call(self.comm.write_cmd_and_read_back, cmd, data, timeout)
+
+    async def update_firmware(self, img, window=1, delta=False):
+        return await self.call(self.comm.update_firmware, window, delta, img)
+
+    async def close(self):
+        await self.call(self.comm.Quit)
+        self.executor.shutdown()
+
+async def open_rack(interface='spi', busAddr=None, red_ports=(), **kwargs):
+    # open every MPC04 (or the given RedRemote ports) concurrently,
+    # adapters that fail to connect or raise while opening are left out
+    opens = []
+    if interface == 'spi' or interface == 'i2c':
+        for device in find_adapters():
+            opens.append(AsyncComm2.open(ip=interface, busAddr=busAddr, device=device, **kwargs))
+    for port in red_ports:
+        opens.append(AsyncComm2.open(ip='red', port=port, **kwargs))
+    results = await asyncio.gather(*opens, return_exceptions=True)
+    comms = []
+    for index, c in enumerate(results):
+        if isinstance(c, BaseException):
+            print("adapter %d: open failed, %s: %s" % (index, type(c).__name__, c))
+        elif not c.comm.connected:
+            await c.close()
         else:
-            #self.socket.close()
+            comms.append(c)
+    return comms
+
+FLASH_AREA_NAMES = ('APP_CODE', 'APP_CONFIG', 'DISPLAY')
+
+async def flash_device(index, comm, img, window=1, delta=False, retries=1):
+    total = sum(img.getFlashArea(name).length for name in FLASH_AREA_NAMES if img.getFlashArea(name) != None)
+    written = [0, 0] # bytes written in this attempt, last reported percent
+    def progress(size):
+        # runs on the adapter's worker thread
+        written[0] = written[0] + size
+        percent = written[0] * 100 // total if total else 100
+        if percent >= written[1] + 10:
+            written[1] = percent - percent % 10
+            print("[adapter %d] %d%%" % (index, written[1]))
+    comm.comm.flash_progress = progress
+    comm.comm.tag = "[adapter %d]" % index
+    start_time = time.time()
+    ok = False
+    attempts = 0
+    while not ok and attempts <= retries:
+        attempts = attempts + 1
+        if attempts > 1:
+            print("[adapter %d] retry %d" % (index, attempts - 1))
+        written[0] = 0
+        written[1] = 0
+        try:
+            ok = await comm.call(comm.comm.flash_image, img, window, delta)
+        except Exception as e:
+            # a link error (USBError, socket error) fails this attempt,
+            # not the whole rack
+            print("[adapter %d] %s: %s" % (index, type(e).__name__, e))
+            ok = False
+    elapsed = time.time() - start_time
+    print("[adapter %d] %s after %d attempt(s), %.1fs" % (index, "OK" if ok else "FAIL", attempts, elapsed))
+    return {'adapter': index, 'ok': ok, 'attempts': attempts, 'seconds': elapsed, 'bytes': written[0],
+            'stats': comm.comm.stats}
+
+async def flash_rack(img, interface='spi', busAddr=None, red_ports=(), window=1, delta=False, retries=1):
+    # flash every adapter in parallel with one shared image
+    comms = await open_rack(interface, busAddr, red_ports)
+    if not comms:
+        print("no adapter connected")
+        return []
+    start_time = time.time()
+    try:
+        results = await asyncio.gather(*(flash_device(i, c, img, window, delta, retries)
+                                         for i, c in enumerate(comms)))
+    finally:
+        await asyncio.gather(*(c.close() for c in comms))
+    elapsed = time.time() - start_time
+    passed = sum(1 for r in results if r['ok'])
+    written = sum(r['bytes'] for r in results)
+    print("%d/%d devices OK (%.0f%% yield), %d retries, %.1fs, %.0f bytes/s total" % (
+        passed, len(results), passed * 100.0 / len(results),
+        sum(r['attempts'] - 1 for r in results), elapsed, written / elapsed if elapsed else 0))
+    return results
+
+def flash_main(argv):
+    parser = argparse.ArgumentParser(prog='cdci.py flash',
+                                     description='Flash one image to every connected MPC04 (or RedRemote port) in parallel.')
+    parser.add_argument('image', help='TouchBoot image file')
+    parser.add_argument('-i', '--interface', default='spi', choices=['spi', 'i2c', 'red'])
+    parser.add_argument('-a', '--bus-addr', default='20', help='i2c bus address')
+    parser.add_argument('-p', '--red-port', type=int, action='append', default=[], help='RedRemote port, may repeat')
+    parser.add_argument('-w', '--window', type=int, default=1, help='flash writes in flight per device')
+    parser.add_argument('--delta', action='store_true', help='only rewrite pages that differ from the image')
+    parser.add_argument('-r', '--retries', type=int, default=1, help='whole-device retries after a failure')
+    parser.add_argument('--stats', metavar='FILE', help='save link statistics per adapter, json if FILE ends in .json, else prometheus text')
+    args = parser.parse_args(argv)
+    if args.interface == 'red' and not args.red_port:
+        args.red_port = [10001]
+
+    # loaded once, every device reads the same mapped area buffers. If
+    # flash_rack raises, worker threads may still be writing from it, so
+    # the image is only closed after a normal return.
+    img = TouchBootImageFile.load(args.image, lazy=True)
+    img.verifyCRC()
+    results = asyncio.run(flash_rack(img, args.interface, args.bus_addr, args.red_port,
+                                     args.window, args.delta, args.retries))
+    img.close()
+    if args.stats:
+        with open(args.stats, 'w') as f:
+            if args.stats.endswith('.json'):
+                json.dump([dict(r, stats=r['stats'].to_json()) for r in results], f, indent=1)
+            else:
+                f.write(prometheus_text([({'adapter': r['adapter']}, r['stats']) for r in results]))
+    return 0 if results and all(r['ok'] for r in results) else 1
+
+class ReportStream:
+    # reads reports on a background thread into a bounded ring buffer,
+    # consumers take (timestamp, TcmMessage) pairs out with get().
+    # taps are called with every frame on the reader thread itself, so
+    # a slow consumer of the ring can't make them miss any. The reader
+    # stops by itself after limit frames (None: until stop()).
+    def __init__(self, comm, max_frames=1024, taps=(), limit=None):
+        self.comm = comm
+        self.frames = collections.deque(maxlen=max_frames)
+        self.cond = threading.Condition()
+        self.taps = list(taps)
+        self.limit = limit
+        self.received = 0
+        self.dropped = 0
+        self.errors = 0
+        self.running = False
+        self.done = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        # idle polls back off the way wait_response does, but to no more
+        # than a quarter of the time between the last two frames so the
+        # next one is read soon after it is posted
+        interval = POLL_FIRST_INTERVAL
+        max_interval = POLL_MAX_INTERVAL
+        last_time = None
+        while self.running and (self.limit == None or self.received < self.limit):
+            try:
+                msg = self.comm.read_message()
+            except AssertionError:
+                self.errors = self.errors + 1
+                continue
+            if msg == None or msg == IDLE_MESSAGE:
+                time.sleep(interval)
+                interval = min(interval * 2, max_interval)
+                continue
+            now = time.time()
+            if last_time != None:
+                max_interval = min(max((now - last_time) / 4, POLL_FIRST_INTERVAL), POLL_MAX_INTERVAL)
+            last_time = now
+            interval = POLL_FIRST_INTERVAL
+            for tap in self.taps:
+                tap(now, msg)
+            with self.cond:
+                if len(self.frames) == self.frames.maxlen:
+                    # oldest frame falls out of the ring
+                    self.dropped = self.dropped + 1
+                self.frames.append((now, msg))
+                self.received = self.received + 1
+                self.cond.notify()
+        with self.cond:
+            self.done = True
+            self.cond.notify()
+
+    def get(self, timeout=None):
+        # None when nothing came within timeout or the reader is done
+        with self.cond:
+            if not self.frames and not self.done:
+                self.cond.wait(timeout)
+            if not self.frames:
+                return None
+            return self.frames.popleft()
+
+@contextlib.contextmanager
+def debug_off(comm):
+    # a background reader polls all the time, with debug on every
+    # empty poll would be printed
+    debug = comm.debug
+    comm.debug = False
+    try:
+        yield
+    finally:
+        comm.debug = debug
+
+def stream_reports(comm, count=None, display=None, recorder=None, every=1, idle_timeout=2):
+    # read count frames (None: until ctrl-c). The recorder gets every
+    # frame from the reader thread; display, if any, is called with
+    # every every-th frame taken from the ring and only it loses frames
+    # when it can't keep up. A counted stream also stops when the
+    # device goes quiet for idle_timeout seconds.
+    taps = []
+    if recorder != None:
+        taps.append(recorder.write)
+    stream = ReportStream(comm, taps=taps, limit=count)
+    start_time = time.time()
+    taken = 0
+    shown = 0
+    with debug_off(comm):
+        stream.start()
+        try:
+            while True:
+                frame = stream.get(idle_timeout)
+                if frame == None:
+                    if stream.done or count != None:
+                        break
+                    continue
+                if display != None and taken % every == 0:
+                    display(*frame)
+                    shown = shown + 1
+                taken = taken + 1
+        except KeyboardInterrupt:
             pass
+        finally:
+            stream.stop()
+    elapsed = time.time() - start_time
+    frames = stream.received
+    print("%d frames in %.2fs (%.1f frames/s), %d shown, %d dropped from the display, %d read errors" % (
+        frames, elapsed, frames / elapsed if elapsed else 0, shown, stream.dropped, stream.errors))
+    if recorder != None:
+        print("%d frames recorded to %s" % (recorder.frames, recorder.path))
+    return frames
+
+def stream_args(comm, args, count, recorder):
+    # "[frames|all] [/n] [quiet]" after kr, gr or gd -> stream_reports
+    # keyword arguments, None if they don't parse. all reads until
+    # ctrl-c, /n shows every n-th frame, quiet only records.
+    kwargs = {'count': count, 'display': lambda t, msg: comm.printPacket(msg), 'recorder': recorder}
+    for arg in args:
+        if arg.isdigit():
+            kwargs['count'] = int(arg)
+        elif arg == 'all':
+            kwargs['count'] = None
+        elif arg.startswith('/') and arg[1:].isdigit() and int(arg[1:]) > 0:
+            kwargs['every'] = int(arg[1:])
+        elif arg == 'quiet':
+            kwargs['display'] = None
+        else:
+            return None
+    if kwargs['display'] == None and recorder == None:
+        print("quiet needs rec=<file> first")
+        return None
+    return kwargs
+
+# capture file: 8 byte file header, then one record per report frame,
+# a record header (timestamp, status code, payload length) followed by
+# the payload bytes. Frames are only ever appended.
+CAPTURE_MAGIC = b'TCRF'
+CAPTURE_VERSION = 1
+CAPTURE_FILE_HEADER = struct.Struct('<4sL')
+CAPTURE_RECORD_HEADER = struct.Struct('<dLL')
+
+class ReportRecorder:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(CAPTURE_FILE_HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION))
+        self.frames = 0
+
+    def write(self, timestamp, msg):
+        self.file.write(CAPTURE_RECORD_HEADER.pack(timestamp, msg.code, len(msg.payload)))
+        self.file.write(msg.payload)
+        self.frames = self.frames + 1
+
+    def close(self):
+        self.file.close()
+
+class ReportCapture:
+    # read side of a capture file, frames are views into the mapping
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version = CAPTURE_FILE_HEADER.unpack_from(self.mapping, 0)
+        if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION:
+            raise ValueError("%s is not a report capture file" % path)
+        self.offsets = None
+
+    def index(self):
+        # record offsets, a trailing partial record is ignored
+        if self.offsets == None:
+            offsets = array.array('Q')
+            offset = CAPTURE_FILE_HEADER.size
+            size = len(self.mapping)
+            while offset + CAPTURE_RECORD_HEADER.size <= size:
+                length = CAPTURE_RECORD_HEADER.unpack_from(self.mapping, offset)[2]
+                if offset + CAPTURE_RECORD_HEADER.size + length > size:
+                    break
+                offsets.append(offset)
+                offset = offset + CAPTURE_RECORD_HEADER.size + length
+            self.offsets = offsets
+        return self.offsets
+
+    def __len__(self):
+        return len(self.index())
+
+    def frame(self, i):
+        # (timestamp, status code, int16 cells shaped rows x cols when known)
+        offset = self.index()[i]
+        timestamp, code, length = CAPTURE_RECORD_HEADER.unpack_from(self.mapping, offset)
+        start = offset + CAPTURE_RECORD_HEADER.size
+        cells = memoryview(self.mapping)[start:start + (length & ~1)]
+        shape = frame_shape(length)
+        if shape != None:
+            return timestamp, code, cells.cast('h', shape)
+        return timestamp, code, cells.cast('h')
+
+    def fixed_stride(self):
+        # (frame count, payload length) when every record has the same
+        # payload length, so records sit at a fixed stride in the file
+        start = CAPTURE_FILE_HEADER.size
+        if len(self.mapping) < start + CAPTURE_RECORD_HEADER.size:
+            return 0, 0
+        length = CAPTURE_RECORD_HEADER.unpack_from(self.mapping, start)[2]
+        stride = CAPTURE_RECORD_HEADER.size + length
+        count = (len(self.mapping) - start) // stride
+        import numpy
+        lengths = numpy.ndarray((count,), dtype='<u4', buffer=self.mapping,
+                                offset=start + 12, strides=(stride,))
+        if (lengths != length).any():
+            raise ValueError("frames have different lengths, use frame()")
+        return count, length
+
+    def array(self, shape=None):
+        # all frames as a zero-copy (N, rows, cols) int16 numpy view
+        import numpy
+        count, length = self.fixed_stride()
+        if shape == None:
+            shape = frame_shape(length) or (1, length // 2)
+        rows, cols = shape
+        if count == 0:
+            return numpy.zeros((0, rows, cols), dtype='<i2')
+        return numpy.ndarray((count, rows, cols), dtype='<i2', buffer=self.mapping,
+                             offset=CAPTURE_FILE_HEADER.size + CAPTURE_RECORD_HEADER.size,
+                             strides=(CAPTURE_RECORD_HEADER.size + length, cols * 2, 2))
+
+    def timestamps(self):
+        import numpy
+        count, length = self.fixed_stride()
+        return numpy.ndarray((count,), dtype='<f8', buffer=self.mapping,
+                             offset=CAPTURE_FILE_HEADER.size,
+                             strides=(CAPTURE_RECORD_HEADER.size + length,))
+
+    def close(self):
+        self.mapping.close()
+
+# ===== symbol index =====
+# variable name -> RAM word address and size, from the linker .lst file.
+# A variable's address is the $XXXX on its "<name>=reg" line, its size
+# the number of WORD lines that mention it.
+
+Symbol = collections.namedtuple('Symbol', 'name address words')
+
+LST_REG = re.compile(r'(\w+)=reg', re.I)
+LST_ADDRESS = re.compile(r'\$([0-9A-Fa-f]+)')
+LST_WORD = re.compile(r'\bWORD\b')
+LST_NAME = re.compile(r'\w+')
+
+class SymbolIndex:
+    def __init__(self, path, mtime, symbols):
+        self.path = path
+        self.mtime = mtime
+        # lower case name -> Symbol
+        self.symbols = symbols
+        self.names = sorted(symbols)
 
+    @staticmethod
+    def parse(path):
+        addresses = {}
+        word_counts = collections.Counter()
+        with open(path, 'r', errors='replace') as f:
+            for line in f:
+                m = LST_REG.search(line)
+                if m != None:
+                    address = LST_ADDRESS.search(line)
+                    if address != None:
+                        addresses.setdefault(m.group(1), int(address.group(1), 16))
+                if LST_WORD.search(line):
+                    # count each name once per line, like grep | wc -l
+                    word_counts.update(set(name.lower() for name in LST_NAME.findall(line)))
+        return dict((name.lower(), Symbol(name, address, word_counts[name.lower()]))
+                    for name, address in addresses.items())
+
+    @classmethod
+    def load(cls, path, cache=True):
+        # parsed symbols are kept next to the .lst file and reused until
+        # the .lst file changes
+        mtime = os.path.getmtime(path)
+        cache_path = path + '.symcache.json'
+        if cache:
+            try:
+                with open(cache_path) as f:
+                    cached = json.load(f)
+                if cached['mtime'] == mtime:
+                    return cls(path, mtime, dict((key, Symbol(*value)) for key, value in cached['symbols'].items()))
+            except (OSError, ValueError, KeyError, TypeError):
+                pass
+        symbols = cls.parse(path)
+        if cache:
+            try:
+                with open(cache_path, 'w') as f:
+                    json.dump({'mtime': mtime, 'symbols': symbols}, f)
+            except OSError:
+                pass
+        return cls(path, mtime, symbols)
+
+    def stale(self):
+        try:
+            return os.path.getmtime(self.path) != self.mtime
+        except OSError:
+            return True
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def lookup(self, name):
+        return self.symbols.get(name.lower())
+
+    def search(self, prefix):
+        prefix = prefix.lower()
+        start = bisect.bisect_left(self.names, prefix)
+        found = []
+        for name in self.names[start:]:
+            if not name.startswith(prefix):
+                break
+            found.append(self.symbols[name])
+        return found
+
+    def fuzzy(self, name, n=5):
+        return [self.symbols[match] for match in difflib.get_close_matches(name.lower(), self.names, n)]
+
+def print_symbol_values(symbols, values):
+    for symbol, data in zip(symbols, values):
+        if data == None:
+            print("%s $%04X: read fail" % (symbol.name, symbol.address))
+            continue
+        words = decode_frame(data)
+        shape = frame_shape(len(data))
+        if shape != None:
+            print("%s $%04X, %d words:" % (symbol.name, symbol.address, len(words)))
+            sys.stdout.write(format_frame(words, shape[0], shape[1]))
+        elif len(words) <= 8:
+            print("%s $%04X = %s" % (symbol.name, symbol.address,
+                                     ' '.join('0x%04x' % (w & 0xffff) for w in words)))
+        else:
+            print("%s $%04X, %d words:" % (symbol.name, symbol.address, len(words)))
+            print(format_hex_dump(data))
+
+def load_symbol_index(index, path):
+    # the index of path, parsed again only when the file changed
+    if index != None and index.path == path and not index.stale():
+        return index
+    try:
+        index = SymbolIndex.load(path)
+    except OSError as e:
+        print("can't read lst file", e)
+        return None
+    print("%d symbols in %s" % (len(index), path))
+    return index
+
+def resolve_ram_names(index, names):
+    # names are symbols, or word addresses $XXXX / 0xXXXX with an
+    # optional word count, e.g. $1000:4
+    found = []
+    for name in names:
+        if name.startswith('$') or name.lower().startswith('0x'):
+            addr, sep, words = name.lstrip('$').partition(':')
+            try:
+                found.append(Symbol(name, int(addr, 16), int(words) if words else 1))
+            except ValueError:
+                print("bad address %s" % name)
+            continue
+        if index == None:
+            print("%s: no lst file loaded" % name)
+            continue
+        symbol = index.lookup(name)
+        if symbol == None:
+            matches = index.search(name)
+            if len(matches) == 1:
+                symbol = matches[0]
+        if symbol == None:
+            matches = index.search(name) or index.fuzzy(name)
+            if matches:
+                print("%s not found, did you mean: %s" % (name, ', '.join(m.name for m in matches)))
+            else:
+                print("%s not found" % name)
+            continue
+        found.append(symbol)
+    return found
+
+class RamWatch:
+    # polls RAM ranges every interval seconds on a background thread,
+    # consumers take (timestamp, [(symbol, old, new)]) out with get(),
+    # only for polls where something changed. Every complete sample can
+    # also go to a ReportRecorder as one 0x81 record.
+    def __init__(self, comm, symbols, interval=0.1, recorder=None, max_changes=1024):
+        self.comm = comm
+        self.symbols = symbols
+        self.interval = interval
+        self.recorder = recorder
+        self.plan = plan_ram_reads([(symbol.address, max(symbol.words, 1)) for symbol in symbols])
+        self.changes = collections.deque(maxlen=max_changes)
+        self.cond = threading.Condition()
+        self.samples = 0
+        self.errors = 0
+        self.late = 0
+        self.failure = None # the link error that stopped the thread
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        last = [None] * len(self.symbols)
+        next_time = time.time()
+        while self.running:
+            try:
+                values = self.comm.read_ram_plan(self.plan, len(self.symbols))
+            except AssertionError:
+                values = [None]
+            except OSError as e:
+                # USBError, socket error: the link is gone, polling on
+                # would only fail again
+                self.comm.stats.link_errors += 1
+                with self.cond:
+                    self.failure = e
+                    self.cond.notify()
+                return
+            timestamp = time.time()
+            self.samples = self.samples + 1
+            if None in values:
+                self.errors = self.errors + 1
+            else:
+                if self.recorder != None:
+                    payload = b''.join(values)
+                    self.recorder.write(timestamp, TcmMessage(0x81, len(payload), payload))
+                changed = [(self.symbols[i], last[i], value) for i, value in enumerate(values) if value != last[i]]
+                last = values
+                if changed:
+                    with self.cond:
+                        self.changes.append((timestamp, changed))
+                        self.cond.notify()
+            next_time = next_time + self.interval
+            delay = next_time - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # the reads took longer than the interval
+                self.late = self.late + 1
+                next_time = time.time()
+
+    def get(self, timeout=None):
+        with self.cond:
+            if not self.changes and self.failure == None:
+                self.cond.wait(timeout)
+            if not self.changes:
+                return None
+            return self.changes.popleft()
+
+def format_ram_change(symbol, old, new, max_words=8):
+    words = decode_frame(new)
+    if len(words) <= max_words:
+        return "%s = %s" % (symbol.name, ' '.join('0x%04x' % (w & 0xffff) for w in words))
+    if old == None:
+        return "%s = %s ... (%d words)" % (symbol.name, ' '.join('0x%04x' % (w & 0xffff) for w in words[:max_words]), len(words))
+    old_words = decode_frame(old)
+    changed = [i for i in range(len(words)) if words[i] != old_words[i]]
+    text = ' '.join('[%d] 0x%04x->0x%04x' % (i, old_words[i] & 0xffff, words[i] & 0xffff) for i in changed[:max_words])
+    if len(changed) > max_words:
+        text = text + ' +%d more' % (len(changed) - max_words)
+    return "%s %s" % (symbol.name, text)
+
+def watch_ram(comm, symbols, interval=0.1, log_path=None):
+    # print what changes until ctrl-c. log_path gets every sample in
+    # the capture format, with the symbol layout in log_path.json
+    recorder = None
+    if log_path != None:
+        recorder = ReportRecorder(log_path)
+        with open(log_path + '.json', 'w') as f:
+            json.dump([symbol._asdict() for symbol in symbols], f, indent=1)
+    watch = RamWatch(comm, symbols, interval, recorder)
+    print("watching %d variables in %d reads every %gs, ctrl-c to stop" % (len(symbols), len(watch.plan), interval))
+    start_time = time.time()
+    with debug_off(comm):
+        watch.start()
+        try:
+            while True:
+                change = watch.get(0.5)
+                if change == None:
+                    if watch.failure != None:
+                        print("watch stopped, %s: %s" % (type(watch.failure).__name__, watch.failure))
+                        break
+                    continue
+                timestamp, changed = change
+                for symbol, old, new in changed:
+                    print("%9.3f %s" % (timestamp - start_time, format_ram_change(symbol, old, new)))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watch.stop()
+            if recorder != None:
+                recorder.close()
+    elapsed = time.time() - start_time
+    print("%d samples in %.2fs (%.1f/s), %d failed, %d late" % (
+        watch.samples, elapsed, watch.samples / elapsed if elapsed else 0, watch.errors, watch.late))
+    return watch.samples
 
 def main(argv):
     i2c_addr = '50'
     last_str = ""
+    recorder = None
+    symbols = None
     str = ""
     global img_file_path
+    global lst_file_path
     print("len of argv", len(argv))
     if len(argv) == 1:
         interface = 'spi'
@@ -918,6 +2443,9 @@ def main(argv):
             interface = 'i2c'
         elif argv[1].lower() == 'spi':
             interface = 'spi'
+        elif argv[1].lower() == 'sim':
+            # simulated device, no hardware needed
+            interface = 'sim'
         else:
             interface = 'red'
             subprocess.getstatusoutput("~/bin/start-red-remote.sh")
@@ -941,7 +2469,7 @@ def main(argv):
         cm2.Quit()
         return
 
-    #cm2.printPacket(cm2.readMsg())
+    #cm2.printPacket(cm2.read_message())
 
     #raw = cm2.getDatabyCmd(cmdCode='02', statusCode='01')
     #B1 = raw[18]
@@ -968,134 +2496,88 @@ def main(argv):
             if str == "usbr":
                 cm2._usbRead()
                 continue
-            if str == "hdl":            
+            if str == "hdl" or str.startswith("hdl "):
+                # "hdl hex" sends the image hex encoded instead of base64
                 if img_file_path == None:
                     print("no img file path, return")
-                f35_img_file = TouchBootImageFile.load(img_file_path) 
-                f35_app_code = f35_img_file.flashAreas[1]["data"]  #1 should be app
-                app_code_len = len(f35_app_code)
-                retry = 10
-                while (True):
-                    hdl_request=cm2._usbWrite("target=0 raw wr=8000 rd=1\n")
-                    retry = retry - 1
-                    if hdl_request == None:
-                        continue
-                    r = re.search(r'data="\S+"', hdl_request).group().strip()
-                    if r == None and retry > 0:
-                        continue
-                    break
-                print("hdl_request is", hdl_request)
-                r = re.search(r'data="\S+"', hdl_request).group().strip()
-                if r != 'data="4B"':
-                    print("not request fw, return")
                     continue
-                cm2._usbRead()
-                cm2._usbRead()
-                if True:
-                    cm2._usbWrite("target=0 raw wr=001804")
-                    download_str="target=0 raw wr=001c download at=0 size=%d\n" % app_code_len
-                    cm2._usbWrite(download_str)
-                    print("f35_app_code size", app_code_len)
-                    f35_app_code_str = ""
-                    for i in range(0, len(f35_app_code)):
-                        f35_app_code_str = f35_app_code_str + "%02x" % f35_app_code[i]
-                    f35_app_code_str = f35_app_code_str + "\n"
-                    send_str="wr=001c" + f35_app_code_str
-                    cm2.sendCmd(send_str.strip())
-                    time.sleep(0.3)
-                    cm2._usbRead()
-                    cm2._usbRead()
-                else:
-                    f35_app_code_str = ""
-                    for i in range(0, len(f35_app_code)):
-                        f35_app_code_str = f35_app_code_str + "%02x" % f35_app_code[i]
-                    cmd_str = "target=0 hdl crc at=0 size=%d" % app_code_len
-                    cm2._usbWrite(cmd_str)
-                    remain = app_code_len % 512
-                    if remain == 0:
-                        remain = 512
-                        indexs = app_code_len // 512
-                    else:
-                        indexs = app_code_len // 512 + 1
-                    for i in range(0, indexs):
-                        str_index = i * 512
-                        data_size = 512
-                        if i == indexs - 1:
-                            data_size = remain
-                        cmd_str = "target=0 hdl send idx=%d data="%i + f35_app_code_str[str_index*2 :str_index*2 + data_size * 2]
-                        cm2._usbWrite(cmd_str)
-                    cm2._usbWrite("target=0 config raw pl=spi pull-ups=yes spiMode=3 byteDelay=10 bitRate=500 attn=none ssActive=low mode=slave base64=yes")
-                    cm2._usbRead()
-                    cm2._usbWrite("target=0 asic reset level=low output=open-drain time=1000")
-                    cm2._usbRead()
-                    cm2._usbWrite("target=0 raw wr=001804")
-                    cm2._usbRead()
-                    cmd_str = "target=0 raw wr=001c download at=0 size=%d" % app_code_len
-                    cm2._usbWrite(cmd_str)
-                    cm2._usbRead()
-                    cm2._usbRead()
-                    time.sleep(0.2)
-                    #cm2._usbWrite("target=0 raw rd=4")
-                    
-                response_code,response_data_len,response_data = cm2.read_msg_bytes()
-                if (response_code == 0x10):
-                    print("download app ok")
-                    response_code,response_data_len,response_data = cm2.read_msg_bytes()
-                    if (response_code == 0x1b):
-                        print("need to download app_config display_config", response_data[0] & 0x04, response_data[0] & 0x02)
-                        if (response_data[0] & 0x04 == 0x04):
-                            print("download app config")
-                            app_config_data = f35_img_file.flashAreas[2]["data"]  #2 should be app config
-                            #data_str = "0101"
-                            #for i in range(0, len(app_config_data)):
-                                #data_str = data_str + "%02x" % app_config_data[i]
-                            #raw_data_size = len(app_config_data) + 2
-                            #data_str = "%02x%02x" % (int(raw_data_size % 256), int(raw_data_size // 256)) + data_str
-                            #data_str = "%02x%02x" % (int(raw_data_size % 256), int(raw_data_size // 256)) + "data_str"
-
-                            cm2.download_config("app", app_config_data, len(app_config_data))
-                        if (response_data[0] & 0x02 == 0x02):
-                            print("download disp")
-                            display_data = f35_img_file.flashAreas[3]["data"]    #3 should be display config
-                            cm2.download_config("disp", display_data, len(display_data))
-
-                        if "app" == cm2.getDeviceMode():                                            
-                            print("host download success")
-                            #print("fw information is \n",f35_img_file.flashAreas[1]["name"], f35_img_file.flashAreas[1]["length"], f35_img_file.flashAreas[1]["crc"])                            
-                            raw = cm2.getDatabyCmd(cmdCode='02', statusCode='01')
-                            B1 = raw[18]
-                            B2 = raw[19]
-                            B3 = raw[20]
-                            B4 = raw[21]
-                            packrat = B4 << 24 | B3 << 16 | B2 << 8 | B1
-                            print('Packrat={}'.format(packrat))
-                            print("fw information is \n",f35_img_file.flashAreas[1]["name"], f35_img_file.flashAreas[1]["length"], f35_img_file.flashAreas[1]["crc"])
-                            print("fw information is \n",f35_img_file.flashAreas[2]["name"], f35_img_file.flashAreas[2]["length"], f35_img_file.flashAreas[2]["crc"])
-                            print("fw information is \n",f35_img_file.flashAreas[3]["name"], f35_img_file.flashAreas[3]["length"], f35_img_file.flashAreas[3]["crc"])
+                f35_img_file = TouchBootImageFile.load(img_file_path, lazy=True)
+                if cm2.host_download(f35_img_file, HDL_CHUNK_SIZE, "hex" not in str.split()[1:]):
+                    raw = cm2.getDatabyCmd(cmdCode='02', statusCode='01')
+                    if raw != None:
+                        B1 = raw[18]
+                        B2 = raw[19]
+                        B3 = raw[20]
+                        B4 = raw[21]
+                        packrat = B4 << 24 | B3 << 16 | B2 << 8 | B1
+                        print('Packrat={}'.format(packrat))
+                    for area_name in ('APP_CODE', 'APP_CONFIG', 'DISPLAY'):
+                        area = f35_img_file.getFlashArea(area_name)
+                        if area != None:
+                            print("fw information is \n", area.name, area.length, area.crc)
+                f35_img_file.close()
                 continue
 
-            if str == "up":            
+            if str == "up" or str.startswith("up "):
+                # "up <n>" keeps n flash writes in flight
+                # "up delta" only rewrites the pages that differ from the image
+                window = 1
+                delta = False
+                for up_arg in str.split()[1:]:
+                    if up_arg.isdigit():
+                        window = int(up_arg)
+                    elif up_arg == "delta":
+                        delta = True
                 #print(img.flashAreas[0]["data"][1])
-                device_mode = cm2.getDeviceMode()
-                if device_mode == "app":
-                    code,len_bytes,data=cm2.write_cmd_and_read_back('1f')
-                    if code != 0x10:
-                        print("enter bl NG")
-                        continue
-                    if data[1] == 0xc:
-                        print("enter bl OK")
-                    else:
-                        print("enter bl NG")
-                if device_mode == "unknown":
+                cm2.flash_image(None, window, delta)
+                continue
+            if str.startswith("watch#"):
+                # watch#a,b,$1000:4 [seconds] [log file] polls until ctrl-c
+                watch_args = str.split()
+                watch_names = watch_args[0].split('#', 1)[1].split(',')
+                try:
+                    interval = float(watch_args[1]) if len(watch_args) > 1 else 0.1
+                except ValueError:
+                    print("watch#<names> [seconds] [log file]")
                     continue
-                
-                code,len_bytes,data = cm2.write_cmd_and_read_back('11','0808', 1)
-                if code == 0x01:
-                    print("erase ok")
+                if lst_file_path != None:
+                    symbols = load_symbol_index(symbols, lst_file_path)
+                found = resolve_ram_names(symbols, watch_names)
+                if found:
+                    watch_ram(cm2, found, interval, watch_args[2] if len(watch_args) > 2 else None)
+                continue
+            if str == "stats" or str.startswith("stats "):
+                # "stats" prints json, "stats prom" prometheus text,
+                # "stats reset" clears, a file name after either saves it
+                stats_args = str.split()[1:]
+                if stats_args[:1] == ["reset"]:
+                    cm2.stats.reset()
+                    continue
+                if stats_args[:1] == ["prom"]:
+                    text = cm2.stats.prometheus()
+                    stats_args = stats_args[1:]
                 else:
-                    print("erase NG")
+                    text = json.dumps(cm2.stats.to_json(), indent=1) + "\n"
+                if stats_args:
+                    with open(stats_args[0], "w") as f:
+                        f.write(text)
+                else:
+                    sys.stdout.write(text)
+                continue
+            if str.split()[:1] in (['kr'], ['gr'], ['gd']):
+                # kr/gr/gd [frames|all] [/n] [quiet]
+                stream_cmd = str.split()
+                kwargs = stream_args(cm2, stream_cmd[1:], 200 if stream_cmd[0] == 'kr' else 10, recorder)
+                if kwargs == None:
+                    print("%s [frames|all] [/n] [quiet]" % stream_cmd[0])
                     continue
-                cm2.update_firmware()
+                # gr: enable report 13 (raw), gd: 12 (delta) while streaming
+                report_id = {'gr': '13', 'gd': '12'}.get(stream_cmd[0])
+                if report_id != None:
+                    cm2.write_cmd_and_read_back('05', report_id)
+                stream_reports(cm2, **kwargs)
+                if report_id != None:
+                    cm2.write_cmd_and_read_back('06', report_id)
                 continue
             if str == "er":
                 device_mode = cm2.getDeviceMode()
@@ -1122,7 +2604,15 @@ def main(argv):
                 cmds = str.split('=')
                 cmd = cmds[0]
                 data = cmds[1]
-                if cmd == 'rd' or cmd == 'r':
+                if cmd == 'rec':
+                    # rec=<file> records streamed frames, rec=off stops
+                    if recorder != None:
+                        print("%d frames recorded to %s" % (recorder.frames, recorder.path))
+                        recorder.close()
+                        recorder = None
+                    if data != 'off':
+                        recorder = ReportRecorder(data)
+                elif cmd == 'rd' or cmd == 'r':
                     cm2.sendCmd('rd=' + cmds[1])
                 else:
                     if len(data) < 3:
@@ -1151,29 +2641,7 @@ def main(argv):
                 packrat = B4 << 24 | B3 << 16 | B2 << 8 | B1
                 print('Packrat={}'.format(packrat))
             elif str=='r':               
-                cm2.printPacket(cm2.readMsg())
-            elif str=='kr':
-                cnt = 200
-                while cnt > 0:               
-                    cm2.printPacket(cm2.readMsg())
-                    cnt = cnt -1
-                    time.sleep(0.2)
-            elif str=='gr':
-                cm2.write_cmd_and_read_back('05','13')
-                cnt = 10
-                while cnt > 0:               
-                    cm2.printPacket(cm2.readMsg())
-                    cnt = cnt -1
-                    time.sleep(0.2)
-                cm2.write_cmd_and_read_back('06','13')    
-            elif str=='gd':
-                cm2.write_cmd_and_read_back('05','12')
-                cnt = 10
-                while cnt > 0:               
-                    cm2.printPacket(cm2.readMsg())
-                    cnt = cnt -1
-                    time.sleep(0.2)
-                cm2.write_cmd_and_read_back('06','12')  
+                cm2.printPacket(cm2.read_message())
             elif str[0]=='p':
                 #print("print variable here")
                 if lst_file_path == None:
@@ -1198,63 +2666,32 @@ def main(argv):
                             #print("TPC%dB :0x%x"%(i,(response_data[16 + i*2] | response_data[16 + i*2 + 1] << 8)))
                         
                     continue
-                cmd = "grep -irn %s  %s | grep -i %s=reg | awk '{print $2}'" % (p_string,lst_file_path, p_string)
-                cmd2 = "grep -irn  %s  %s  | grep WORD | wc -l" % (p_string,lst_file_path)
-                print(cmd)
-                retcode, output = subprocess.getstatusoutput(cmd)
-                retcode2, output2 = subprocess.getstatusoutput(cmd2)
-                if (retcode == 0):
-                    print(output)
-                    output = output.strip("$")
-                    print(output)
-                    addr_str = ""
-                    length_str = ""
-                    if len(output) <=2:
-                        addr_str = output[0:2] + '00'                        
-                    else:                    
-                        addr_str = output[2:] + output[0:2]
-                    if int(output2) > 256:
-                        length_str = "%02x" % (int(output2) % 256) + "%02x" % (int(output2) // 256)
-                    else:                    
-                        length_str = "%02x" % (int(output2) % 256) + "00"
-                    ram_cmd = 'wr=810400' + addr_str + length_str
-
-                    cmd_data_str = addr_str + length_str
-                    print(ram_cmd)
-                    cm2.sendCmd(ram_cmd, True, '01')
-                    continue
-
-                    response_code,response_data_len,response_data = cm2.write_cmd_and_read_back("81",cmd_data_str, 1)
-                    if (response_code == 0x01) and response_data_len >= 16 * 36:
-                        index = 0
-                        out_range = False
-                        for t in range(0,tx_cnt):
-                            row_data = ""
-                            if out_range == True:
-                                continue
-                            for r in range(0, rx_cnt):
-                                if index + 1 >= response_data_len:
-                                    out_range = True
-                                    continue
-                                row_data = row_data + "%04x, " % (response_data[index] + response_data[index + 1] * 256)
-                                index = index + 2
-                            print("row at %d" % t, row_data)
-                else:
+                # p#name reads a variable, p#a,b,c several in as few
+                # 81 reads as possible, p#prefix* lists matching names
+                symbols = load_symbol_index(symbols, lst_file_path)
+                if p_string.endswith('*'):
+                    if symbols != None:
+                        for symbol in symbols.search(p_string[:-1]):
+                            print("%-40s $%04X %d words" % symbol)
                     continue
+                found = resolve_ram_names(symbols, p_string.split(','))
+                values = cm2.read_ram_batch([(symbol.address, max(symbol.words, 1)) for symbol in found])
+                print_symbol_values(found, values)
+                continue
             else:
                 if str == 'q' or str == 'quit':
                     break
                 elif str == 'run123456': # disable this feature since not working yet
                     cnt = 0
                     while True:
-                        cm2.printPacket(cm2.readMsg())
+                        cm2.printPacket(cm2.read_message())
                         time.sleep(0.003)
                         cnt = cnt + 1
                         #if msvcrt.kbhit():
                         #  msvcrt.getch()
                         #  break
                 elif str == 'check':                
-                    cm2.printPacket(cm2.readMsg())
+                    cm2.printPacket(cm2.read_message())
                 elif str == 'rmi4':
                     cm2.rmi_mode = True
                 elif str == 'comm2':
@@ -1274,21 +2711,41 @@ def main(argv):
                         else:
                             str = 'wr=' + id + '0000'   #comm2
                     cm2.sendCmd(str.strip())
+    if recorder != None:
+        recorder.close()
     cm2.Quit()
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'verify':
+        sys.exit(verify_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'flash':
+        sys.exit(flash_main(sys.argv[2:]))
     USAGE = '''
 Released on Dec.5, 2019, by Rover Shen.
 This is a tool for cdci console replacement when using MPC04 to connect with TouchComm module.
 You need to install filter driver over MPC04 USB devices provided by LibUSB-Win32 toolkit before using it.
 LibUSB-Win32 can be downloaded here:
 https://sourceforge.net/projects/libusb-win32/
+Batch image check without a device: cdci.py verify [-j jobs] [-o report.json] <img or dir>...
+Flash all connected adapters at once: cdci.py flash [-w window] [--delta] <img>
+Try it without hardware against a simulated device: cdci.py sim
 Example:
 cmd=05c0  #enable c0 report and read until $01(OK) response is received
 rd=1200   #read 1200 bytes from interface
 wr=1f     #enter bootloader and read a response
 wrnr=04   #software reset without reading anything
+up        #update firmware from the image file given on the command line
+up 4      #same, with 4 flash writes in flight at a time
+up delta  #same, only erase and write the pages that differ from the image
+stats     #link statistics as json (stats prom: prometheus text, stats reset: clear)
 check     #try to read a packet
+kr        #stream up to 200 report frames from a reader thread, ctrl-c to stop
+kr all /10 #stream until ctrl-c, show every 10th frame
+kr all quiet #only record, until ctrl-c (gr and gd take the same options)
+rec=a.bin #also record streamed frames to a.bin (rec=off to stop)
+p#name    #read a variable from ram, p#a,b,c reads several, p#pre* lists names
+watch#a,b #show a and b (names or $addr:words) as they change, ctrl-c to stop
+watch#a 0.05 w.bin #poll every 50ms and log every sample to w.bin
 run       #keep reading packet, any key to stop
 quit      #quit the script
 '''
@@ -0,0 +1,257 @@
+#!/usr/bin/python3
+# benchmarks for the hot paths of cdci.py, run against the simulated
+# device so no hardware is needed
+# usage: cdci_bench.py [-t seconds] [--save-baseline FILE] [--baseline FILE] [case ...]
+
+import argparse
+import contextlib
+import csv
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+
+import cdci
+
+# i2c_parse_log.py sits at the top of the repo
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import i2c_parse_log
+
+devnull = open(os.devnull, 'w')
+
+def quiet():
+    # most of Comm2 prints as it goes
+    return contextlib.redirect_stdout(devnull)
+
+def legacy_read_msg_parse(text):
+    # the per-packet parsing readMsg/_usbWrite did before parse_response
+    if re.search(r'err', text) != None:
+        return None
+    r = re.search(r'"A5\S+"', text)
+    if r == None:
+        return None
+    r = re.sub('"', '', r.group().strip())
+    return [int(r[index:index + 2], 16) for index in range(0, len(r), 2)]
+
+def mpc04_reply(payload_len):
+    packet = bytes([0xA5, 0x01, payload_len % 256, payload_len // 256]) + bytes(range(256)) * (payload_len // 256) + bytes(payload_len % 256)
+    return 'target=0 raw rd=%d data="%s"\n' % (len(packet), packet.hex().upper())
+
+def bench(results, name, fn, arg, seconds, nbytes=None):
+    # run fn(arg) for about the given time, return ops/s. Batches grow
+    # from one call so slow cases don't overshoot the time.
+    calls = 0
+    batch = 1
+    start = time.perf_counter()
+    deadline = start + seconds
+    while True:
+        for i in range(batch):
+            fn(arg)
+        calls = calls + batch
+        now = time.perf_counter()
+        if now >= deadline:
+            break
+        batch = min(batch * 2, 100)
+    ops = calls / (now - start)
+    report(results, name, ops, nbytes)
+    return ops
+
+def report(results, name, ops, nbytes=None):
+    line = '%-40s %12.1f ops/s' % (name, ops)
+    result = {'ops': ops}
+    if nbytes != None:
+        line = line + ' %10.2f MB/s' % (ops * nbytes / 1e6)
+        result['bytes'] = ops * nbytes
+    print(line)
+    results[name] = result
+
+def sim_comm(mode='app', queue_depth=1, report_interval=0.01):
+    # Comm2 on a simulated device that answers at once, so only host
+    # side time is measured
+    latency = dict((code, 0) for code in cdci.SIM_COMMAND_LATENCY)
+    device = cdci.SimTouchCommDevice(mode, latency, queue_depth, report_interval, default_latency=0)
+    with quiet():
+        comm = cdci.Comm2(ip='sim', transport=cdci.SimTransport(device))
+    return comm
+
+def bench_parser(results, seconds):
+    for payload_len in (0, 36 * 18 * 2, 4096):
+        text = mpc04_reply(payload_len)
+        assert bytes(legacy_read_msg_parse(text)) == cdci.parse_response(text).packet
+        legacy = bench({}, 'regex parse, %d byte payload' % payload_len, legacy_read_msg_parse, text, seconds, len(text))
+        compiled = bench(results, 'parse_response, %d byte payload' % payload_len, cdci.parse_response, text, seconds, len(text))
+        print('%-40s %12.1fx' % ('speedup', compiled / legacy))
+
+def bench_image(results, seconds):
+    tmp = tempfile.mkdtemp()
+    for size in (64 * 1024, 256 * 1024, 1024 * 1024):
+        img = cdci.TouchBootImageFile()
+        app = os.urandom(size)
+        config = os.urandom(4096)
+        img.addFlashArea('APP_CODE', 0x4000, app, {}, len(app), 0)
+        img.addFlashArea('APP_CONFIG', 0x1e000, config, {}, len(config), 0)
+        img.setJSONSection(json.dumps({'size': size}))
+        path = os.path.join(tmp, 'bench_%d.img' % size)
+        bench(results, 'image save, %dK' % (size // 1024), img.save, path, seconds, size)
+        file_size = os.path.getsize(path)
+        bench(results, 'image load, %dK' % (size // 1024), cdci.TouchBootImageFile.load, path, seconds, file_size)
+        def load_lazy(path):
+            cdci.TouchBootImageFile.load(path, lazy=True).close()
+        bench(results, 'image load lazy, %dK' % (size // 1024), load_lazy, path, seconds, file_size)
+        os.remove(path)
+    os.rmdir(tmp)
+
+def bench_flash(results, seconds):
+    size = 64 * 1024
+    data = os.urandom(size)
+    comm = sim_comm('bl')
+    view = memoryview(data)
+    def encode(view):
+        for offset in range(0, size, 512):
+            comm.flash_chunk(view, 0x8000, offset, 512).hex()
+    bench(results, 'writeFlash chunk encoding, 64K', encode, view, seconds, size)
+    for window in (1, 4):
+        comm = sim_comm('bl', queue_depth=window)
+        def write(data):
+            with quiet():
+                comm.writeFlash(0x8000, data, size, window)
+        bench(results, 'writeFlash on sim, 64K, window %d' % window, write, data, seconds, size)
+
+def bench_long_cmd(results, seconds):
+    comm = sim_comm('bl')
+    for config_type, size in (('app', 4096), ('disp', 16 * 1024)):
+        config = list(os.urandom(size))
+        def download(config):
+            with quiet():
+                comm.download_config(config_type, config, size)
+        bench(results, 'download_config on sim, %s %dK' % (config_type, size // 1024), download, config, seconds, size)
+
+def bench_hdl(results, seconds):
+    size = 128 * 1024
+    img = cdci.TouchBootImageFile()
+    app = os.urandom(size)
+    img.addFlashArea('APP_CODE', 0, app, {}, len(app), 0)
+    comm = sim_comm('hdl')
+    for use_base64, name in ((True, 'base64'), (False, 'hex')):
+        def download(img):
+            comm.transport.device.mode = 'hdl'
+            with quiet():
+                assert comm.host_download(img, cdci.HDL_CHUNK_SIZE, use_base64)
+        bench(results, 'host_download on sim, 128K, %s' % name, download, img, seconds, size)
+
+def bench_read(results, seconds):
+    comm = sim_comm('app', report_interval=0)
+    comm.write_cmd_and_read_back('05', b'\x13')
+    frame_len = len(comm.transport.device.report_frame)
+    bench(results, 'readMsg, report frame', lambda arg: comm.readMsg(), None, seconds, frame_len)
+    bench(results, 'read_msg_bytes, report frame', lambda arg: comm.read_msg_bytes(), None, seconds, frame_len)
+
+def bench_print(results, seconds):
+    comm = sim_comm()
+    frame = comm.transport.device.report_frame
+    msg = cdci.TcmMessage(0x13, len(frame), frame)
+    dump = cdci.TcmMessage(0x01, 4096, bytes(range(256)) * 16)
+    def show(msg):
+        with quiet():
+            comm.printPacket(msg)
+    bench(results, 'printPacket, report frame', show, msg, seconds, len(frame))
+    bench(results, 'printPacket, frame as hex text', show, cdci.message_hex(msg), seconds, len(frame))
+    bench(results, 'printPacket, 4K hex dump', show, dump, seconds, 4096)
+
+def write_i2c_csv(path, rows):
+    # a logic analyzer export: a page select, a register address, then
+    # a read of the register, over and over
+    with open(path, 'w', newline='') as f:
+        out = csv.writer(f)
+        out.writerow(['Id', 'Start', 'End', 'Bus', 'Length', 'Status', 'Cond', 'Address', 'Type', 'Data'])
+        n = 0
+        while n < rows:
+            page = n % 10
+            addr = (n // 10) % 256
+            value = (n // 2560) % 4
+            out.writerow([n, '', '', 'I2C', '2B', '', 'SP', '0x2C', 'Write Transaction', 'FF %02d' % page])
+            out.writerow([n + 1, '', '', 'I2C', '1B', '', 'S', '0x2C', 'Write Transaction', '%02X' % addr])
+            out.writerow([n + 2, '', '', 'I2C', '8B', '', 'SP', '0x2C', 'Read Transaction',
+                          ' '.join('%02X' % ((addr + value + i) % 256) for i in range(8))])
+            n = n + 3
+
+def bench_i2c_log(results, rows):
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'i2c_poweron.csv')
+    out_path = os.path.join(tmp, 'func_make_data.c')
+    write_i2c_csv(path, rows)
+    size = os.path.getsize(path)
+    start = time.perf_counter()
+    i2c_parse_log.make_data(path, out_path, quiet=True)
+    elapsed = time.perf_counter() - start
+    report(results, 'i2c_parse_log, %d rows' % rows, 1 / elapsed, size)
+    print('%-40s %12.0f rows/s' % ('', rows / elapsed))
+    os.remove(path)
+    os.remove(out_path)
+    os.rmdir(tmp)
+
+CASES = {
+    'parse': bench_parser,
+    'image': bench_image,
+    'flash': bench_flash,
+    'longcmd': bench_long_cmd,
+    'hdl': bench_hdl,
+    'read': bench_read,
+    'print': bench_print,
+}
+
+def compare(results, baseline, tolerance):
+    # ops/s against the baseline, returns the names that got slower
+    # by more than tolerance
+    slower = []
+    print()
+    print('%-40s %12s %12s %8s' % ('case', 'baseline', 'now', 'change'))
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base == None:
+            print('%-40s %12s %12.1f %8s' % (name, '-', result['ops'], 'new'))
+            continue
+        change = result['ops'] / base['ops'] - 1
+        mark = ''
+        if change < -tolerance:
+            mark = ' SLOWER'
+            slower.append(name)
+        print('%-40s %12.1f %12.1f %+7.1f%%%s' % (name, base['ops'], result['ops'], change * 100, mark))
+    return slower
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='benchmark cdci.py hot paths against a simulated device')
+    parser.add_argument('cases', nargs='*', help='cases to run: %s, i2c (default all)' % ', '.join(CASES))
+    parser.add_argument('-t', '--seconds', type=float, default=0.5, help='time per case')
+    parser.add_argument('--rows', type=int, default=30000, help='rows in the generated i2c capture')
+    parser.add_argument('--save-baseline', metavar='FILE', help='write the results to FILE')
+    parser.add_argument('--baseline', metavar='FILE', help='compare with results saved earlier')
+    parser.add_argument('--tolerance', type=float, default=10, help='percent slower before a case counts as a regression')
+    args = parser.parse_args(argv[1:])
+
+    cases = args.cases or list(CASES) + ['i2c']
+    results = {}
+    for case in cases:
+        if case == 'i2c':
+            bench_i2c_log(results, args.rows)
+        elif case in CASES:
+            CASES[case](results, args.seconds)
+        else:
+            parser.error('unknown case %s' % case)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'seconds': args.seconds, 'results': results}, f, indent=1, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        slower = compare(results, baseline, args.tolerance / 100)
+        if slower:
+            print('%d case(s) slower than the baseline' % len(slower))
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -1,69 +1,155 @@
 #!/usr/bin/python3
-import csv
 #-*-coding:utf-8-*-
-line_counter = 0
-page_index = 0
-i2c_addr = 0
-strlist = []
-for i  in range(10 * 256):
-    strlist.append(" ")
+# Turns a logic analyzer I2C export (csv) into make_page_<n>_data()
+# C functions, one switch case per register value read back.
+# usage: i2c_parse_log.py [-q | -s] [-o func_make_data.c] [capture.csv | -]
+#
+# Also importable: transactions(path) yields the capture as typed
+# Transaction tuples, reading it a row at a time.
+import argparse
+import collections
+import csv
+import shutil
+import sys
+import tempfile
+import time
+
+PAGES = 10
+
+# kind : 'read' or 'write'
+# page, address : the page and register address selected when it happened
+# length : byte count from the capture
+# data : the bytes
+# line : csv line number
+Transaction = collections.namedtuple('Transaction', 'kind page address length data line')
+
+def parse_rows(rows):
+    # csv rows -> Transaction, for the rows the analyzer marks as a
+    # complete transaction. A 2 byte "FF <page>" write selects the page,
+    # a 1 byte write the register address.
+    page_index = 0
+    i2c_addr = 0
+    for line_counter, i in enumerate(rows, 1):
+        if len(i) <= 9 or i[7] == "None" or (i[6] != "SP" and i[6] != "S"):
+            continue
+        if i[8] == "Write Transaction":
+            kind = 'write'
+        elif i[8] == "Read Transaction":
+            kind = 'read'
+        else:
+            continue
+        try:
+            lens = int(i[4].strip("B"))
+            data = bytes.fromhex(i[9].strip("*"))
+        except ValueError:
+            continue
+        if kind == 'write' and lens == 2 and data[:1] == b'\xff':
+            page_index = data[1]
+        elif kind == 'write' and lens == 1:
+            i2c_addr = data[0]
+        yield Transaction(kind, page_index, i2c_addr, lens, data, line_counter)
+
+def open_capture(path):
+    if path == '-':
+        return open(sys.stdin.fileno(), 'r', newline='', closefd=False)
+    return open(path, 'r', newline='')
+
+def transactions(path):
+    with open_capture(path) as f:
+        for transaction in parse_rows(csv.reader(f)):
+            yield transaction
+
+def format_transaction(t):
+    return "page %d i2c_addr:%x len: %d data: %s" % (t.page, t.address, t.length, t.data.hex(' ').upper())
+
+class MakeDataWriter:
+    # collects the switch cases of every page in a temp file per page,
+    # so memory stays flat however long the capture is
+    def __init__(self, pages=PAGES):
+        self.pages = [tempfile.TemporaryFile('w+') for i in range(pages)]
+        self.cases = [0] * pages
+        # page * 256 + register address -> last value read
+        self.last = {}
+
+    def add(self, t):
+        # returns None for a value seen before, 'new' for the first read
+        # of a register, 'conflict' when it reads back a different value
+        key = t.page * 256 + t.address
+        previous = self.last.get(key)
+        if previous == t.data:
+            return None
+        self.last[key] = t.data
+        newString = ",".join("0x%02X" % b for b in t.data)
+        self.pages[t.page].write(
+            "\t\tcase %x" % t.address + ":\n"
+            + "\t\t{\n" + "\t\t\tuint8 char t[] = {" + newString + "};\n"
+            + "\t\t\tmemcpy(make_data, t, sizeof(t));\n"
+            + "\t\t\tmakedata_len = %d;\n" % t.length
+            + "\t\t" + "}\n"
+            + "\t\t" + "break;\n")
+        self.cases[t.page] = self.cases[t.page] + 1
+        if previous == None:
+            return 'new'
+        return 'conflict'
+
+    def write(self, func_file):
+        for i, page in enumerate(self.pages):
+            func_file.write("void make_page_%d_data(void)\n" % i + "{\n")
+            func_file.write("\tswitch (i2c_addr) {\n")
+            page.seek(0)
+            shutil.copyfileobj(page, func_file)
+            func_file.write("\t\tdefault:\n")
+            func_file.write("\t\tbreak;\n")
+            func_file.write("\t}\n")
+            func_file.write("}\n")
+
+    def close(self):
+        for page in self.pages:
+            page.close()
+
+def make_data(path, out_path, quiet=False):
+    # whole conversion, returns the counts for a summary
+    counts = collections.Counter()
+    writer = MakeDataWriter()
+    try:
+        for t in transactions(path):
+            counts[t.kind] += 1
+            if t.kind == 'write':
+                if t.length >= 2 and t.data[:1] != b'\xff' and not quiet:
+                    print("write data found line:", t.line, format_transaction(t))
+                continue
+            if t.page >= PAGES:
+                counts['bad page'] += 1
+                continue
+            result = writer.add(t)
+            if result != None:
+                counts[result] += 1
+            if result == 'conflict' and not quiet:
+                print("conflict data found line", t.line, format_transaction(t))
+        with open(out_path, "w") as func_file:
+            writer.write(func_file)
+        counts['cases'] = sum(writer.cases)
+    finally:
+        writer.close()
+    return counts
 
-page_func_list = ["", "", "", "", "", "", "", "", "", ""]
-for i in range(10):
-    page_func_list[i] = "void make_page_%d_data(void)\n" % i + "{\n"
-    page_func_list[i] += "\tswitch (i2c_addr) {\n"
-func_file = open("./func_make_data.c", "w")
-with open('./i2c_poweron.csv', 'r') as f:
-    raw_list = []
-    rander = csv.reader(f)
-    for i in rander:
-        line_counter = line_counter + 1
-        if len(i) > 9:
-            if i[7] != "None" and (i[6] == "SP" or i[6] == "S") :
-                lens = i[4]
-                lens = lens.strip("B")
-                lens = int(lens)
-                byte_str = i[9].strip("*")
-                #print(byte_str)
-                if i[8] == "Write Transaction" and lens >= 2 and byte_str.split(" ")[0] != "FF":
-                    print("write data found line:" , line_counter, "page", page_index, "i2c_addr:%x" % i2c_addr,"len:", lens,"data:", byte_str)
-                if i[8] == "Write Transaction" and lens == 2:
-                    if byte_str.split(" ")[0] == "FF":
-                        #print("line :%d this is a write, and set page %d" % (line_counter,page_index))
-                        page_index = int(byte_str.split(" ")[1])
-                if i[8] == "Write Transaction" and lens == 1:
-                    i2c_addr = int(byte_str.split(" ")[0], 16)
-                    #print("this is a set i2c addr")
-                    pass
-                if i[8] == "Read Transaction":
-                    #newByteStr = byte_str.replace(" ", ",")
-                    tmp_array = byte_str.split(" ")
-                    newString = ""
-                    for k in tmp_array:
-                        k = "0x" + k + ","
-                        newString += k
-                    newString = newString[:-1]
-                    #print(newByteStr)
-                    if (strlist[page_index * 256 + i2c_addr] != newString):
-                        if strlist[page_index * 256 + i2c_addr] != "":
-                            print("conflict data found line " , line_counter, "page", page_index, "i2c_addr:%x" % i2c_addr,"len:", lens,"data:",byte_str)
-                        page_func_list[page_index] += "\t\tcase %x" % i2c_addr + ":\n"
-                        page_func_list[page_index] += "\t\t{\n" + "\t\t\tuint8 char t[] = {" + newString + "};\n"
-                        page_func_list[page_index] += "\t\t\tmemcpy(make_data, t, sizeof(t));\n"
-                        page_func_list[page_index] += "\t\t\tmakedata_len = %d;\n" % lens
-                        page_func_list[page_index] += "\t\t" + "}\n"
-                        page_func_list[page_index] += "\t\t" + "break;\n"
-                        strlist[page_index * 256 + i2c_addr] = newString
-                    else:
-                        pass
-                        #print("same value found!!!")
-    for i in range(10):
-        #print(page_func_list[i])
-        page_func_list[i] += "\t\tdefault:\n"
-        page_func_list[i] += "\t\tbreak;\n"
-        page_func_list[i] += "\t}\n"
-        page_func_list[i] += "}\n"
-        func_file.write(page_func_list[i])
-    func_file.close()
+def main(argv):
+    parser = argparse.ArgumentParser(description='make_page_<n>_data() C functions from an I2C capture')
+    parser.add_argument('capture', nargs='?', default='./i2c_poweron.csv', help="csv export, - for stdin")
+    parser.add_argument('-o', '--output', default='./func_make_data.c')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('-q', '--quiet', action='store_true', help='no per-transaction output')
+    group.add_argument('-s', '--summary', action='store_true', help='only counts at the end')
+    args = parser.parse_args(argv[1:])
 
+    start_time = time.time()
+    counts = make_data(args.capture, args.output, args.quiet or args.summary)
+    if args.summary:
+        elapsed = time.time() - start_time
+        print("%d writes, %d reads, %d registers, %d conflicts, %d cases in %s, %.2fs" % (
+            counts['write'], counts['read'], counts['new'], counts['conflict'],
+            counts['cases'], args.output, elapsed))
+    return 0
 
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))